@@ -3,7 +3,15 @@
 
 
 import nest as nestlib
+import json
 import logging
+import socket
+import sys
+import threading
+from StringIO import StringIO
+from functools import wraps
+from os import remove
+from time import time
 from jcalfred import Workflow, Item, Keychain
 
 
@@ -16,34 +24,359 @@ MODES = {
               'and cool to a maximum temperature'}
 }
 
+# seconds before a saved status snapshot is refreshed
+STATUS_TTL = 60
 
-class NestWorkflow(Workflow):
-    def __init__(self, *args, **kw):
-        super(NestWorkflow, self).__init__(*args, **kw)
-        self.keychain = Keychain('jc-nest')
-        self.account = self._get_account()
-        self.nest = None
+# seconds a command sent to the daemon may take, including the time it waits
+# for earlier commands
+COMMAND_DEADLINE = 60
+
+# the most queries to cache results for per command
+MAX_CACHED_QUERIES = 50
+
+ITEM_FIELDS = ('subtitle', 'arg', 'valid')
+
+
+def _normalize(query):
+    return u' '.join((query or u'').strip().strip('"').lower().split())
 
-        LOG.debug('nests: %s', self.account.nests)
 
-        if 'nest' in self.config:
+class ResultCache(object):
+    '''Items computed by tell_ commands, saved between Alfred invocations.
+
+    The cache belongs to one version of the account's status snapshot, and is
+    emptied when the snapshot changes, which is checked on every read so a
+    long-running process sees changes too. Items are also dropped once they're
+    ttl seconds old, so a command that reads the status runs again and can
+    notice that the snapshot is stale. Nothing is cached while there's no
+    snapshot.
+    '''
+
+    def __init__(self, cache_file, version, ttl):
+        self._cache_file = cache_file
+        self._version = version
+        self._ttl = ttl
+        self._loaded_version = None
+        self._entries = None
+
+    @property
+    def entries(self):
+        version = self._version()
+        if self._entries is None or version != self._loaded_version:
+            # entries are saved with the version they were computed from
+            self._loaded_version = version
+            self._entries = None
             try:
-                self.nest = self.account.nests[self.config['nest']]
-                LOG.debug('using saved nest id %s', self.config['nest'])
+                with open(self._cache_file, 'rt') as cfile:
+                    data = json.load(cfile)
+                if data['version'] == self._loaded_version:
+                    self._entries = data['entries']
+            except IOError:
+                pass
             except Exception:
-                LOG.exception('unable to use saved nest ID %s',
-                              self.config['nest'])
+                LOG.exception('corrupt result cache')
+            if self._entries is None:
+                self._entries = {}
+        return self._entries
+
+    def get(self, command, query):
+        '''Get the cached items for a query, if there are any'''
+        entry = self.entries.get(command, {}).get(query)
+        if not isinstance(entry, dict) or time() - entry['time'] > self._ttl:
+            return None
+        return [Item(i['title'], **dict((k, v) for k, v in i.items()
+                                        if k != 'title'))
+                for i in entry['items']]
+
+    def put(self, command, query, items):
+        '''Cache the items for a query'''
+        entries = self.entries
+        if self._loaded_version is None:
+            return
+        cached = entries.setdefault(command, {})
+        if len(cached) >= MAX_CACHED_QUERIES:
+            cached.clear()
+        data = []
+        for item in items:
+            values = {'title': item.title}
+            for field in ITEM_FIELDS:
+                value = getattr(item, field, None)
+                if value is not None:
+                    values[field] = value
+            data.append(values)
+        cached[query] = {'time': time(), 'items': data}
+        self._save()
+
+    def clear(self):
+        '''Empty the cache'''
+        self._entries = {}
+        try:
+            remove(self._cache_file)
+        except OSError:
+            pass
+
+    def _save(self):
+        try:
+            nestlib.write_file_atomically(self._cache_file, json.dumps(
+                {'version': self._loaded_version, 'entries': self._entries}))
+        except Exception:
+            LOG.exception('unable to save result cache')
+
+
+def _rank(query, terms):
+    '''Rank how well a query matches the best of a list of terms.
+
+    Lower is better: a prefix of a term, then a prefix of a word in a term,
+    then a substring, then the query's characters in order. Returns None if
+    no term matches.
+    '''
+    best = None
+    for term in terms:
+        if term.startswith(query):
+            rank = (0, 0)
+        elif any(word.startswith(query) for word in term.split()):
+            rank = (1, 0)
+        elif query in term:
+            rank = (2, term.index(query))
+        else:
+            start = pos = term.find(query[0])
+            for char in query[1:]:
+                if pos < 0:
+                    break
+                pos = term.find(char, pos + 1)
+            if pos < 0:
+                continue
+            # prefer matches that are close together
+            rank = (3, pos - start)
+        if best is None or rank < best:
+            best = rank
+    return best
+
+
+class SearchIndex(object):
+    '''A ranked search over a list of entries, saved between invocations.
+
+    Entries are dicts with a "title" and a list of lowercase "terms" to match
+    the query against. The index belongs to one version of the account's
+    status snapshot. When the version changes, build() is called for a key
+    and entries, and the saved entries are only replaced if the key changed.
+    The matches for recent queries are kept, so a longer query only has to
+    search the matches of its longest saved prefix.
+    '''
+
+    def __init__(self, index_file, version):
+        self._index_file = index_file
+        self._version = version
+        self._data = None
+
+    def _load(self):
+        try:
+            with open(self._index_file, 'rt') as ifile:
+                return json.load(ifile)
+        except IOError:
+            pass
+        except Exception:
+            LOG.exception('corrupt search index')
+        return {'version': None, 'key': None, 'entries': [], 'matches': {}}
+
+    def _update(self, build):
+        data = self._data
+        if data is None:
+            data = self._data = self._load()
+        version = self._version()
+        if version is not None and version == data['version']:
+            return False
+
+        key, entries = build()
+        if key != data['key']:
+            LOG.debug('rebuilding search index %s', self._index_file)
+            data['key'] = key
+            data['entries'] = entries
+            data['matches'] = {}
+        data['version'] = version
+        return True
+
+    def search(self, query, build):
+        '''Return the entries matching a query, best first'''
+        query = _normalize(query)
+        changed = self._update(build)
+        data = self._data
+        entries = data['entries']
+        matches = data['matches']
+
+        if query in matches:
+            found = matches[query]
+        else:
+            candidates = None
+            for end in range(len(query) - 1, -1, -1):
+                if query[:end] in matches:
+                    candidates = matches[query[:end]]
+                    break
+            if candidates is None:
+                candidates = range(len(entries))
+
+            if query:
+                ranked = []
+                for i in candidates:
+                    rank = _rank(query, entries[i]['terms'])
+                    if rank is not None:
+                        ranked.append((rank, entries[i]['title'].lower(), i))
+                ranked.sort()
+                found = [entry[-1] for entry in ranked]
+            else:
+                found = sorted(candidates,
+                               key=lambda i: entries[i]['title'].lower())
+
+            if len(matches) >= MAX_CACHED_QUERIES:
+                matches.clear()
+            matches[query] = found
+            changed = True
+
+        if changed:
+            self._save()
+        return [entries[i] for i in found]
+
+    def _save(self):
+        try:
+            nestlib.write_file_atomically(self._index_file,
+                                          json.dumps(self._data))
+        except Exception:
+            LOG.exception('unable to save search index')
+
+
+def cached_items():
+    '''Cache the items returned by a tell_ command'''
+    def decorator(tell):
+        command = tell.__name__
+
+        @wraps(tell)
+        def wrapper(self, query=u''):
+            query = _normalize(query)
+            items = self.results.get(command, query)
+            if items is not None:
+                LOG.debug('using cached items for %s "%s"', command, query)
+                return items
+
+            items = tell(self, query)
+            self.results.put(command, query, items)
+            return items
+        return wrapper
+    return decorator
+
+
+def projected(*buckets):
+    '''Declare the status buckets of the active Nest that a command reads.
+
+    Unless the full status is already available, only those buckets are
+    fetched while the command runs. buckets are "shared", "device" or
+    "structure".
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args):
+            nest_id = self._config('nest')
+            structure_id = self._config('structure')
+            if not nest_id or not structure_id:
+                return method(self, *args)
+
+            keys = []
+            for bucket in buckets:
+                id = structure_id if bucket == 'structure' else nest_id
+                keys.append('{0}.{1}'.format(bucket, id))
+            with self.account.projection(keys):
+                return method(self, *args)
+        return wrapper
+    return decorator
 
-        if not self.nest:
-            LOG.debug('using first nest id')
-            self.nest = self.account.nests.values()[0]
-            self.config['nest'] = self.nest.id
+
+class NestWorkflow(Workflow):
+    def __init__(self, *args, **kw):
+        super(NestWorkflow, self).__init__(*args, **kw)
+        self._keychain = None
+        self._account = None
+        self._nest = None
+        self._results = None
+        self._indexes = {}
+        self._serving = False
+
+    @property
+    def keychain(self):
+        if self._keychain is None:
+            self._keychain = Keychain('jc-nest')
+        return self._keychain
+
+    @property
+    def account(self):
+        if self._account is None:
+            self._account = self._get_account()
+        return self._account
+
+    @property
+    def results(self):
+        if self._results is None:
+            status_file = '{0}/status.json'.format(self.cache_dir)
+            self._results = ResultCache(
+                '{0}/results.json'.format(self.cache_dir),
+                lambda: nestlib.snapshot_version(status_file), STATUS_TTL)
+        return self._results
+
+    def _index(self, name):
+        '''Get the search index for a picker'''
+        if name not in self._indexes:
+            status_file = '{0}/status.json'.format(self.cache_dir)
+            self._indexes[name] = SearchIndex(
+                '{0}/{1}_index.json'.format(self.cache_dir, name),
+                lambda: nestlib.snapshot_version(status_file))
+        return self._indexes[name]
+
+    @property
+    def nest(self):
+        if self._nest is None:
+            if 'nest' in self.config:
+                try:
+                    self._nest = self.account.nest(
+                        self.config['nest'], self._config('structure'))
+                    LOG.debug('using saved nest id %s', self.config['nest'])
+                except Exception:
+                    LOG.exception('unable to use saved nest ID %s',
+                                  self.config['nest'])
+                    # the command may be projected onto the stale Nest's
+                    # buckets, so load the whole status to find another
+                    self.account.refresh()
+
+            if not self._nest:
+                LOG.debug('using first nest id')
+                self._nest = self.account.nests.values()[0]
+                self.config['nest'] = self._nest.id
+                self.config['structure'] = self._nest.structure.id
+
+            if 'structure' not in self.config:
+                self.config['structure'] = self._nest.structure.id
+        return self._nest
+
+    @nest.setter
+    def nest(self, nest):
+        self._nest = nest
+
+    def _config(self, key):
+        return self.config[key] if key in self.config else None
+
+    def _credentials(self):
+        '''The saved email and password, used to renew the session'''
+        entry = self.keychain.get_password('nest')
+        if not entry:
+            return None
+        return entry['comment'], entry['password']
 
     def _get_account(self):
         '''Get an authenticated Nest object'''
         LOG.debug('getting Nest')
 
-        account = nestlib.Account(cache_dir=self.cache_dir)
+        # a served account lives on, so it refreshes in a thread
+        account = nestlib.Account(cache_dir=self.cache_dir,
+                                  status_ttl=STATUS_TTL,
+                                  credentials=self._credentials,
+                                  refresh_in_thread=self._serving)
 
         if not account.has_session:
             entry = self.keychain.get_password('nest')
@@ -88,46 +421,130 @@ class NestWorkflow(Workflow):
 
         return account
 
+    # daemon #############################
+
+    @property
+    def socket_path(self):
+        return '{0}/daemon.sock'.format(self.cache_dir)
+
+    def tell(self, *args):
+        if not self._forward('tell', args):
+            super(NestWorkflow, self).tell(*args)
+
+    def do(self, *args):
+        if not self._forward('do', args):
+            super(NestWorkflow, self).do(*args)
+
+    def _forward(self, op, args):
+        '''Run a command in the daemon if one is running'''
+        if self._serving:
+            return False
+        from nest_daemon import Client, DaemonError
+        try:
+            client = Client(self.socket_path, timeout=COMMAND_DEADLINE + 5)
+        except socket.error:
+            return False
+        # once a command is sent it mustn't be run again here, since it may
+        # already have been applied
+        with client:
+            try:
+                output = client.call(op, args=args)
+            except socket.timeout:
+                raise DaemonError('The daemon didn\'t answer in time')
+        sys.stdout.write(output.encode('utf-8'))
+        return True
+
+    def serve(self):
+        '''Run commands for other workflow processes from a warm account'''
+        from nest_daemon import Daemon, DaemonError
+        self._serving = True
+        lock = threading.Lock()
+
+        def run(op):
+            def handler(request):
+                deadline = time() + COMMAND_DEADLINE
+                with lock:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise DaemonError('Timed out waiting for earlier '
+                                          'commands')
+                    # pick up a Nest chosen since the last command
+                    self._nest = None
+                    stdout = sys.stdout
+                    sys.stdout = StringIO()
+                    try:
+                        with self.account.deadline(remaining):
+                            getattr(self, op)(*request['args'])
+                        return sys.stdout.getvalue()
+                    finally:
+                        sys.stdout = stdout
+            return handler
+
+        daemon = Daemon(self.account, self.socket_path)
+        daemon.register('tell', run('tell'))
+        daemon.register('do', run('do'))
+        try:
+            daemon.serve_forever()
+        finally:
+            daemon.server_close()
+
     def do_debug(self, ignored):
         '''Opent the debug log file'''
         LOG.debug('opening log file %s', self.log_file)
         import os
         os.system('open "{0}"'.format(self.log_file))
 
+    def _nest_entries(self):
+        '''The search index key and entries for the Nest picker'''
+        entries = []
+        for nest in self.account.nests.values():
+            name = unicode(nest.name)
+            location = unicode(nest.structure.name)
+            entries.append({
+                'title': name,
+                'subtitle': u'ID: {0}    Location: {1}'.format(
+                    nest.id, location),
+                'arg': nest.id,
+                'terms': [name.lower(), location.lower(), nest.id.lower()],
+            })
+        # the index only changes when Nests are added, removed or renamed
+        key = sorted([e['arg'], e['title'], e['subtitle']] for e in entries)
+        return key, entries
+
+    @cached_items()
     def tell_nest(self, query):
         '''Display the available Nests'''
         LOG.debug('listing Nests')
+        active = self._config('nest') or self.nest.id
 
         items = []
-        for nest in self.account.nests.values():
-            title = unicode(nest.name)
-            if nest.id == self.nest.id:
+        for entry in self._index('nest').search(query, self._nest_entries):
+            title = entry['title']
+            if entry['arg'] == active:
                 title += u' (active)'
-            subtitle = u'ID: {0}    Location: {1}'.format(nest.id,
-                                                          nest.structure.name)
-            items.append(Item(title, subtitle=subtitle, arg=nest.id,
-                              valid=True))
-
-        if len(query.strip()) > 0:
-            q = query.strip().lower()
-            items = self.fuzzy_match_list(q, items,
-                                          key=lambda i: i.title.lower())
+            items.append(Item(title, subtitle=entry['subtitle'],
+                              arg=entry['arg'], valid=True))
 
         return items
 
     def do_nest(self, nest_id):
         '''Select the active Nest'''
         LOG.debug('selecting Nest')
-        self.nest = self.account.nests[nest_id]
+        self.nest = self.account.nest(nest_id)
         self.config['nest'] = nest_id
+        self.config['structure'] = self.nest.structure.id
+        self.results.clear()
         self.puts(u'Set active Nest to "{0}" ({1})'.format(self.nest.name,
                                                            nest_id))
 
     def do_clear(self, ignored):
         '''Clear your nest session'''
-        self.nest.account.clear_session()
+        nestlib.Account(cache_dir=self.cache_dir).clear_session()
+        self.results.clear()
         self.puts(u'Session cleared')
 
+    @cached_items()
+    @projected('device', 'shared')
     def tell_target(self, temp):
         '''Tell the target temperature'''
         LOG.debug('telling target temperature')
@@ -169,6 +586,7 @@ class NestWorkflow(Workflow):
 
         return [item]
 
+    @projected('device', 'shared')
     def do_target(self, temp):
         '''Set the target temperature'''
         LOG.debug('doing target temperature')
@@ -177,6 +595,7 @@ class NestWorkflow(Workflow):
         if ' ' in temp:
             temp = temp.split()
         self.nest.target_temperature = temp
+        self.results.clear()
         units = self.nest.scale.upper()
 
         if isinstance(temp, list):
@@ -185,6 +604,8 @@ class NestWorkflow(Workflow):
         else:
             self.puts(u'Target temperature set to %s°%s' % (temp, units))
 
+    @cached_items()
+    @projected('device', 'shared', 'structure')
     def tell_status(self, ignore):
         '''Tell the Nest's overall status'''
         LOG.debug('telling status')
@@ -209,6 +630,8 @@ class NestWorkflow(Workflow):
             target, humidity, fan, away)
         return [item]
 
+    @cached_items()
+    @projected('device')
     def tell_fan(self, ignore):
         '''Tell the Nest's fan mode'''
         LOG.debug('telling fan')
@@ -227,6 +650,7 @@ class NestWorkflow(Workflow):
         item = Item(msg, valid=True, arg=arg, subtitle=subtitle)
         return [item]
 
+    @projected('device')
     def do_fan(self, mode):
         '''Set the Nest's fan mode'''
         LOG.debug('doing fan')
@@ -235,12 +659,15 @@ class NestWorkflow(Workflow):
             raise Exception('Invalid input')
 
         self.nest.fan = mode
+        self.results.clear()
 
         if self.nest.fan == 'auto':
             self.puts('Fan is in auto mode')
         else:
             self.puts('Fan is on')
 
+    @cached_items()
+    @projected('structure')
     def tell_away(self, ignore):
         '''Tell the Nest's "away" status'''
         LOG.debug('telling away')
@@ -256,6 +683,7 @@ class NestWorkflow(Workflow):
                     subtitle='Press enter to toggle')
         return [item]
 
+    @projected('structure')
     def do_away(self, val):
         '''Set the Nest's "away" status'''
         LOG.debug('doing away')
@@ -272,6 +700,7 @@ class NestWorkflow(Workflow):
                 raise Exception('Invalid input')
 
             self.nest.structure.away = val
+            self.results.clear()
             away = val
         else:
             away = self.nest.structure.away
@@ -313,27 +742,34 @@ class NestWorkflow(Workflow):
 
         return items
 
+    @cached_items()
+    @projected('device')
     def tell_mode(self, query):
         LOG.debug('telling mode')
-        items = []
 
-        for mode in sorted(MODES.keys()):
-            title = MODES[mode]['label']
-            if mode == self.nest.mode:
-                title += ' (active)'
-            items.append(Item(title, subtitle=MODES[mode]['desc'],
-                         arg=mode, valid=True))
+        def build():
+            entries = [{'title': MODES[mode]['label'],
+                        'subtitle': MODES[mode]['desc'],
+                        'arg': mode,
+                        'terms': [MODES[mode]['label'].lower(), mode]}
+                       for mode in sorted(MODES.keys())]
+            return sorted(MODES.keys()), entries
 
-        if len(query.strip()) > 0:
-            q = query.strip().lower()
-            items = self.fuzzy_match_list(q, items,
-                                          key=lambda i: i.title.lower())
+        items = []
+        for entry in self._index('mode').search(query, build):
+            title = entry['title']
+            if entry['arg'] == self.nest.mode:
+                title += ' (active)'
+            items.append(Item(title, subtitle=entry['subtitle'],
+                              arg=entry['arg'], valid=True))
 
         return items
 
+    @projected('device')
     def do_mode(self, mode):
         LOG.debug('getting mode')
         self.nest.mode = mode
+        self.results.clear()
         label = MODES[mode]['label'].lower()
         self.puts('Temperature mode set to %s' % label)
 
@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 
+import atexit
+import fcntl
 import json
-import requests
 import logging
+import random
 import ssl
+import threading
+from Queue import Queue, Empty
+from calendar import timegm
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from os.path import exists, expanduser, dirname
-from os import makedirs, remove
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.poolmanager import PoolManager
+from os.path import abspath, dirname, exists, expanduser
+from os import devnull, getpid, makedirs, remove, rename, setsid, stat
+from time import sleep, time
+from urllib import quote
+from urlparse import urlparse
+
+# strptime imports this lazily, which isn't thread-safe in Python 2
+import _strptime  # noqa
 
 
 LOG = logging.getLogger(__name__)
@@ -17,14 +28,55 @@ LOG = logging.getLogger(__name__)
 default_cache_dir = expanduser('~/.nest')
 login_url = 'https://home.nest.com/user/login'
 user_agent = 'Nest/2.1.3 CFNetwork/548.0.4'
-
-
-class TlsAdapter(HTTPAdapter):
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = PoolManager(num_pools=connections,
-                                       maxsize=maxsize,
-                                       block=block,
-                                       ssl_version=ssl.PROTOCOL_TLSv1)
+default_pool_connections = 4
+default_pool_maxsize = 10
+default_weather_ttl = 600
+default_timeout = 30
+default_subscribe_timeout = 120
+default_retries = 2
+default_retry_backoff = 0.5
+default_breaker_threshold = 5
+default_breaker_reset = 30
+default_bulk_workers = 8
+default_refresh_ahead = 24 * 60 * 60
+default_renew_retry = 300
+
+# headers that are dropped from requests that shouldn't be authenticated
+anonymous_headers = {
+    'Authorization': None,
+    'X-nl-user-id': None,
+    'X-nl-protocol-version': None,
+}
+
+
+_tls_adapter_class = None
+
+
+def tls_adapter(ssl_version=ssl.PROTOCOL_TLSv1, **kwargs):
+    '''Create an HTTP adapter that connects with ssl_version (TLSv1).
+
+    requests is only imported when the first adapter is created, so importing
+    this module stays cheap for callers that never talk to Nest.
+    '''
+    global _tls_adapter_class
+    if _tls_adapter_class is None:
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.poolmanager import PoolManager
+
+        class TlsAdapter(HTTPAdapter):
+            def __init__(self, ssl_version, **kwargs):
+                # the pool manager is created by HTTPAdapter.__init__
+                self.ssl_version = ssl_version
+                super(TlsAdapter, self).__init__(**kwargs)
+
+            def init_poolmanager(self, connections, maxsize, block=False):
+                self.poolmanager = PoolManager(num_pools=connections,
+                                               maxsize=maxsize,
+                                               block=block,
+                                               ssl_version=self.ssl_version)
+
+        _tls_adapter_class = TlsAdapter
+    return _tls_adapter_class(ssl_version, **kwargs)
 
 
 class FailedRequest(Exception):
@@ -38,12 +90,118 @@ class NotAuthenticated(Exception):
         super(NotAuthenticated, self).__init__(message)
 
 
+class DeadlineExceeded(FailedRequest):
+    def __init__(self, message):
+        super(DeadlineExceeded, self).__init__(message, None)
+
+
+class CircuitOpen(FailedRequest):
+    def __init__(self, message):
+        super(CircuitOpen, self).__init__(message, None)
+
+
+# where each Nest property is found in the account status
+nest_fields = OrderedDict((
+    ('name', ('shared', 'name')),
+    ('temperature', ('shared', 'current_temperature')),
+    ('target_temperature', ('shared', 'target_temperature')),
+    ('target_temperature_low', ('shared', 'target_temperature_low')),
+    ('target_temperature_high', ('shared', 'target_temperature_high')),
+    ('scale', ('device', 'temperature_scale')),
+    ('humidity', ('device', 'current_humidity')),
+    ('leaf', ('device', 'leaf')),
+    ('mode', ('device', 'current_schedule_mode')),
+    ('fan', ('device', 'fan_mode')),
+    ('ip', ('metadata', 'last_ip')),
+))
+
+# the fields Structures and Nests read, for accounts that only keep those
+default_status_fields = {
+    'user': set(['structures']),
+    'structure': set(['name', 'devices', 'postal_code', 'away',
+                      'away_timestamp', 'away_setter']),
+    'shared': set(['target_change_pending']),
+}
+for _bucket, _key in nest_fields.values():
+    default_status_fields.setdefault(_bucket, set()).add(_key)
+
+
+def to_scale(temp, scale):
+    '''Convert a temperature in Celsius to the given scale'''
+    if temp is not None and scale == 'F':
+        temp = (temp * 1.8) + 32
+    return temp
+
+
+def snapshot_version(status_file):
+    '''Identify the current version of a status snapshot without reading it'''
+    try:
+        st = stat(status_file)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime, st.st_size]
+
+
+def write_file_atomically(path, data):
+    '''Replace a file's contents so that readers never see a partial write'''
+    temp_file = '{}.{}.tmp'.format(path, getpid())
+    try:
+        with open(temp_file, 'wt') as tfile:
+            tfile.write(data)
+        rename(temp_file, path)
+    except Exception:
+        if exists(temp_file):
+            remove(temp_file)
+        raise
+
+
+class NestSnapshot(object):
+    '''An immutable view of one Nest's properties at a status version.
+
+    Temperatures are already converted to the Nest's scale.
+    '''
+
+    __slots__ = ('version', 'name', 'scale', 'ip', 'humidity', 'temperature',
+                 'leaf', 'mode', 'fan', 'target_temperature')
+
+    def __init__(self, status, id, version):
+        values = {}
+        for prop, (bucket, key) in nest_fields.items():
+            values[prop] = status.get(bucket, {}).get(id, {}).get(key)
+
+        scale = values['scale']
+        mode = values['mode']
+        if mode is not None:
+            mode = mode.lower()
+        if mode == 'range':
+            target = [to_scale(values['target_temperature_low'], scale),
+                      to_scale(values['target_temperature_high'], scale)]
+        else:
+            target = to_scale(values['target_temperature'], scale)
+
+        init = super(NestSnapshot, self).__setattr__
+        init('version', version)
+        init('name', values['name'])
+        init('scale', scale)
+        init('ip', values['ip'])
+        init('humidity', values['humidity'])
+        init('temperature', to_scale(values['temperature'], scale))
+        init('leaf', values['leaf'])
+        init('mode', mode)
+        init('fan', values['fan'])
+        init('target_temperature', target)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('NestSnapshot is immutable')
+
+
 class Nest(object):
     def __init__(self, id, structure):
         '''Initialize this Nest.'''
         self._id = str(id)
         self._structure = structure
         self._account = structure.account
+        self._snapshot = None
 
     @property
     def account(self):
@@ -53,9 +211,20 @@ class Nest(object):
     def structure(self):
         return self._structure
 
+    @property
+    def snapshot(self):
+        '''This Nest's properties as of the current account status'''
+        status = self.account.status
+        version = self.account.status_version
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = NestSnapshot(status, self.id, version)
+            self._snapshot = snapshot
+        return snapshot
+
     @property
     def name(self):
-        return self.account.status['shared'][self.id]['name']
+        return self.snapshot.name
 
     @property
     def id(self):
@@ -63,66 +232,48 @@ class Nest(object):
 
     @property
     def scale(self):
-        return self.account.status['device'][self.id]['temperature_scale']
+        return self.snapshot.scale
 
     @property
     def ip(self):
-        return self.account.status['metadata'][self.id]['last_ip']
+        return self.snapshot.ip
 
     @property
     def humidity(self):
-        return self.account.status['device'][self.id]['current_humidity']
+        return self.snapshot.humidity
 
     @property
     def temperature(self):
-        temp = self.account.status['shared'][self.id]['current_temperature']
-        if self.scale == 'F':
-            temp = (temp * 1.8) + 32
-        return temp
+        return self.snapshot.temperature
 
     @property
     def leaf(self):
-        return self.account.status['device'][self.id]['leaf']
+        return self.snapshot.leaf
 
     @property
     def mode(self):
-        mode = self.account.status['device'][self.id][
-            'current_schedule_mode']
-        return mode.lower()
+        return self.snapshot.mode
 
     @mode.setter
     def mode(self, mode):
         mode = mode.upper()
-        data = {'device': {self.id: {'current_schedule_mode': mode}}}
-        self.account.request('POST', 'put', data=data)
-        self.account.status['device'][self.id]['current_schedule_mode'] = mode
+        self.account.write('device', self.id,
+                           {'current_schedule_mode': mode})
 
     @property
     def fan(self):
-        return self.account.status['device'][self.id]['fan_mode']
+        return self.snapshot.fan
 
     @fan.setter
     def fan(self, mode):
         if mode not in ('auto', 'on'):
             raise Exception('Invalid fan mode "{}". Must be "auto" or '
                             '"on"'.format(mode))
-        data = {'device': {self.id: {'fan_mode': mode}}}
-        self.account.request('POST', 'put', data=data)
-        self.account.status['device'][self.id]['fan_mode'] = mode
+        self.account.write('device', self.id, {'fan_mode': mode})
 
     @property
     def target_temperature(self):
-        shared = self.account.status['shared'][self.id]
-        if self.mode == 'range':
-            temp = [shared['target_temperature_low'],
-                    shared['target_temperature_high']]
-            if self.scale == 'F':
-                temp = [(t * 1.8) + 32 for t in temp]
-        else:
-            temp = shared['target_temperature']
-            if self.scale == 'F':
-                temp = (temp * 1.8) + 32
-        return temp
+        return self.snapshot.target_temperature
 
     @target_temperature.setter
     def target_temperature(self, temp):
@@ -146,15 +297,7 @@ class Nest(object):
                 'target_temperature': temp
             }
 
-        self.account.request('POST', 'put/shared.{}'.format(self.id),
-                             data=data)
-
-        shared = self.account.status['shared'][self.id]
-        if isinstance(temp, (list, tuple)):
-            shared['target_temperature_low'] = lo_and_hi[0]
-            shared['target_temperature_high'] = lo_and_hi[1]
-        else:
-            shared['target_temperature'] = temp
+        self.account.write('shared', self.id, data)
 
 
 class Structure(object):
@@ -194,7 +337,8 @@ class Structure(object):
     def weather(self):
         url = '{}{}'.format(self.account.session['urls']['weather_url'],
                             self.location)
-        return requests.get(url).json()[self.location]
+        return self.account.weather_cache.get(url, self.location,
+                                              self.account)
 
     # away ###############################
 
@@ -204,38 +348,1001 @@ class Structure(object):
 
     @away.setter
     def away(self, value):
-        from time import time
         value = bool(value)
         data = {
             'away_timestamp': int(time()),
             'away': value,
             'away_setter': 0
         }
-        self.account.request('POST', 'put/structure.{}'.format(self.id),
-                             data=data)
-        self.account.status['structure'][self.id]['away'] = value
+        self.account.write('structure', self.id, data)
 
+    def set_nests(self, target_temperature=None, mode=None, fan=None,
+                  overrides=None):
+        '''Set properties of every Nest in this structure at once.
 
-class Account(object):
-    def __init__(self, cache_dir=None):
-        '''Initialize this nest interface.'''
+        See Account.set_nests.
+        '''
+        return set_nests(self.account, self.nests.values(),
+                         target_temperature, mode, fan, overrides)
+
+
+def set_nests(account, nests, target_temperature=None, mode=None, fan=None,
+              overrides=None):
+    '''Set properties of many Nests with as few requests as possible.'''
+    values = OrderedDict()
+    # mode goes first since it decides what kind of target is valid
+    for name, value in (('mode', mode), ('fan', fan),
+                        ('target_temperature', target_temperature)):
+        if value is not None:
+            values[name] = value
+
+    targets = []
+    for nest in nests:
+        nest_values = values.copy()
+        nest_values.update((overrides or {}).get(nest.id, {}))
+        targets.append((nest.id, nest, nest_values))
+    return _bulk_write(account, targets)
+
+
+def _bulk_write(account, targets):
+    '''Apply (id, object, {property: value}) targets as one batch.
+
+    Returns an OrderedDict mapping each id to None or the exception that kept
+    its values from being set. If the combined request fails, the writes are
+    resent in parallel, one bucket per request, to find the ones that fail;
+    DeadlineExceeded and CircuitOpen are raised instead, since resending
+    wouldn't help.
+    '''
+    results = OrderedDict()
+    outer = account._active_batch
+    with account.batch() as batch:
+        for id, obj, values in targets:
+            results[id] = None
+            try:
+                for name in ('mode', 'fan', 'target_temperature', 'away'):
+                    if name in values:
+                        setattr(obj, name, values[name])
+            except Exception as e:
+                results[id] = e
+        if outer is not None:
+            # the writes will be sent with the enclosing batch
+            return results
+        writes = batch.take()
+
+    # a failed target may have queued some of its writes before failing
+    for key in list(writes):
+        if results.get(key[1]) is not None:
+            del writes[key]
+    if not writes:
+        return results
+
+    try:
+        account._commit(writes)
+        return results
+    except (DeadlineExceeded, CircuitOpen):
+        raise
+    except FailedRequest:
+        LOG.warn('combined write failed; retrying writes separately')
+
+    # deadlines are thread-local, so the caller's is handed to the workers
+    deadline = getattr(account._local, 'deadline', None)
+
+    def commit(item):
+        key, values = item
+        account._local.deadline = deadline
+        try:
+            account._commit(OrderedDict([(key, values)]))
+        except Exception as e:
+            return key, e
+        finally:
+            account._local.deadline = None
+        return key, None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(len(writes), default_bulk_workers))
+    try:
+        for (bucket, id), error in pool.map(commit, writes.items()):
+            if error is not None:
+                results[id] = error
+    finally:
+        pool.close()
+    return results
+
+
+def endpoint_name(path):
+    '''Get a name for an API path with any bucket IDs removed'''
+    return '/'.join(part.split('.')[0] for part in path.split('/'))
+
+
+class Instrument(object):
+    '''Observes the requests and timed operations of an account.
+
+    Subclasses override the hooks they're interested in. endpoint is the
+    request path with IDs removed, such as "put/shared" or "mobile/user".
+    A streamed response's body hasn't been read when after_request is
+    called, so instruments shouldn't read it.
+    '''
+
+    def before_request(self, method, endpoint, url):
+        pass
+
+    def after_request(self, method, endpoint, url, request_bytes, response,
+                      elapsed):
+        pass
+
+    def request_failed(self, method, endpoint, url, error, elapsed):
+        pass
+
+    def timing(self, name, elapsed):
+        '''Called with the time taken by operations like "login"'''
+        pass
+
+
+class CircuitBreaker(object):
+    '''Fails requests fast for hosts that keep failing.
+
+    After `threshold` consecutive failures to a host, requests to it raise
+    CircuitOpen for `reset_after` seconds. A single trial request is then let
+    through; the circuit closes again if it succeeds.
+    '''
+
+    def __init__(self, threshold=None, reset_after=None):
+        if threshold is None:
+            threshold = default_breaker_threshold
+        if reset_after is None:
+            reset_after = default_breaker_reset
+
+        self._threshold = threshold
+        self._reset_after = reset_after
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        '''Raise CircuitOpen if requests to host shouldn't be made'''
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return
+            if time() - opened < self._reset_after:
+                raise CircuitOpen('Circuit open for {}'.format(host))
+            # let one trial request through, and keep failing the rest
+            self._opened[host] = time()
+            self._failures[host] = self._threshold - 1
+
+    def record(self, host, success):
+        '''Record the outcome of a request to host'''
+        with self._lock:
+            if success:
+                self._failures.pop(host, None)
+                self._opened.pop(host, None)
+            else:
+                failures = self._failures.get(host, 0) + 1
+                self._failures[host] = failures
+                if failures >= self._threshold:
+                    if host not in self._opened:
+                        LOG.warn('opening circuit for %s', host)
+                    self._opened[host] = time()
+
+
+# the reports held in memory, and the downloads in progress, of the weather
+# caches that are shared across cache dirs
+_shared_weather_entries = {}
+_shared_weather_pending = {}
+_shared_weather_lock = threading.Lock()
+
+
+class WeatherCache(object):
+    '''A cache of weather reports keyed by location.
+
+    Reports are kept in memory and in the cache dir, and are reused for ttl
+    seconds. Expired reports are revalidated with a conditional request.
+    Concurrent requests for the same location share a single download.
+
+    If shared is True, the reports in memory and the downloads in progress
+    are shared by every shared cache in the process, whatever its cache dir,
+    so each location is only downloaded once. Reports are still saved to
+    each cache's own dir.
+    '''
 
+    def __init__(self, cache_dir=None, ttl=None, shared=False):
         if cache_dir is None:
             cache_dir = default_cache_dir
+        if ttl is None:
+            ttl = default_weather_ttl
+
+        self._weather_dir = '{}/weather'.format(cache_dir)
+        self._ttl = ttl
+        if shared:
+            self._entries = _shared_weather_entries
+            self._pending = _shared_weather_pending
+            self._lock = _shared_weather_lock
+        else:
+            self._entries = {}
+            self._pending = {}
+            self._lock = threading.Lock()
+
+    def get(self, url, location, account):
+        '''Get the weather report for a location using an account's pool'''
+        while True:
+            with self._lock:
+                entry = self._entries.get(location)
+                if entry is None:
+                    entry = self._load(location)
+                if entry is not None and time() - entry['time'] < self._ttl:
+                    return entry['data']
+
+                fetching = self._pending.get(location)
+                if fetching is None:
+                    fetching = threading.Event()
+                    self._pending[location] = fetching
+                    break
+
+            # another thread is already fetching this location
+            fetching.wait()
+
+        try:
+            entry = self._fetch(url, location, account, entry)
+        finally:
+            with self._lock:
+                del self._pending[location]
+            fetching.set()
+
+        return entry['data']
+
+    def clear(self):
+        '''Forget all cached reports held in memory'''
+        with self._lock:
+            self._entries.clear()
+
+    def _fetch(self, url, location, account, entry):
+        headers = dict(anonymous_headers)
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        LOG.debug('fetching weather for %s', location)
+        r = account.send('GET', url, 'weather', headers=headers)
+
+        if r.status_code == 304 and entry is not None:
+            entry = dict(entry, time=time())
+        elif r.status_code == 200:
+            entry = {
+                'time': time(),
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'data': r.json()[location]
+            }
+        else:
+            raise FailedRequest('Weather request failed', r)
 
+        with self._lock:
+            self._entries[location] = entry
+        self._save(location, entry)
+        return entry
+
+    def _load(self, location):
+        try:
+            with open(self._file(location), 'rt') as wfile:
+                entry = json.load(wfile)
+        except IOError:
+            return None
+        except Exception:
+            LOG.exception('corrupt weather cache for %s', location)
+            return None
+        self._entries[location] = entry
+        return entry
+
+    def _save(self, location, entry):
+        try:
+            if not exists(self._weather_dir):
+                makedirs(self._weather_dir)
+            write_file_atomically(self._file(location), json.dumps(entry))
+        except Exception:
+            LOG.exception('unable to save weather for %s', location)
+
+    def _file(self, location):
+        return '{}/{}.json'.format(self._weather_dir,
+                                   quote(unicode(location).encode('utf-8'),
+                                         safe=''))
+
+
+# the weather cache used by accounts that aren't given their own
+_weather_caches = {}
+_weather_caches_lock = threading.Lock()
+
+
+def shared_weather_cache(cache_dir=None):
+    '''Get the weather cache for accounts that use cache_dir.
+
+    Every account in the process shares the reports held in memory; they're
+    saved to the weather dir in cache_dir.
+    '''
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    with _weather_caches_lock:
+        if cache_dir not in _weather_caches:
+            _weather_caches[cache_dir] = WeatherCache(cache_dir, shared=True)
+        return _weather_caches[cache_dir]
+
+
+class Batch(object):
+    '''A set of writes that are sent to Nest in a single request.
+
+    Writes to the same bucket are merged, with later values replacing earlier
+    ones. The cached status is only updated once the batch has been committed.
+    '''
+
+    def __init__(self, account):
+        self._account = account
+        self._writes = OrderedDict()
+        self._outer = None
+
+    @property
+    def account(self):
+        return self._account
+
+    def write(self, bucket, id, values):
+        '''Queue values to be written to a bucket'''
+        self._writes.setdefault((bucket, id), {}).update(values)
+
+    def take(self):
+        '''Remove and return the queued writes without sending them'''
+        writes = self._writes
+        self._writes = OrderedDict()
+        return writes
+
+    def commit(self):
+        '''Send all queued writes to Nest'''
+        writes = self._writes
+        if not writes:
+            return
+        self._writes = OrderedDict()
+        self.account._commit(writes)
+
+    def __enter__(self):
+        self._outer = self.account._active_batch
+        self.account._active_batch = self._outer or self
+        return self.account._active_batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.account._active_batch = self._outer
+        if exc_type is None and self._outer is None:
+            self.commit()
+
+
+class Account(object):
+    def __init__(self, cache_dir=None, pool_connections=None,
+                 pool_maxsize=None, status_ttl=None, weather_cache=None,
+                 instruments=None, timeout=None, retries=None,
+                 hedge_after=None, breaker=None, write_behind=False,
+                 status_fields=None, credentials=None, refresh_ahead=None,
+                 verify=True, ssl_version=None, refresh_in_thread=False):
+        '''Initialize this nest interface.
+
+        pool_connections is the number of hosts to keep connection pools for,
+        and pool_maxsize is the number of connections kept open per host.
+
+        If status_ttl is given, the account status is saved to a snapshot in
+        the cache dir and reused by later instances. A snapshot older than
+        status_ttl seconds is still returned, but a detached child process is
+        started to refresh it, so short-lived processes can exit right away;
+        the new snapshot is loaded when it's next read after the child saves
+        it. Long-lived callers can pass refresh_in_thread to refresh in a
+        thread instead, which updates the status in memory but keeps the
+        process from exiting until the refresh is done.
+
+        Weather reports come from weather_cache, which defaults to a cache
+        that shares reports in memory with every account in the process and
+        saves them in cache_dir.
+
+        instruments is a list of Instrument objects that observe requests.
+
+        Each request times out after timeout seconds, and GETs that fail with
+        a connection error or a 5xx response are retried up to `retries`
+        times. If hedge_after is given, a second status request is started
+        when the first hasn't finished after that many seconds. Requests pass
+        through breaker, a CircuitBreaker, which fails fast for hosts that
+        keep failing.
+
+        With write_behind, setters update the cached status and return right
+        away, and a background thread sends their writes to Nest. Writes
+        still waiting to be sent are reapplied over refreshed statuses. When
+        the process exits it waits up to timeout seconds for queued writes to
+        be sent; call flush() to wait for them sooner, or for longer.
+
+        status_fields maps bucket types to the fields to keep from status
+        responses (see default_status_fields). When it's given, responses are
+        decoded as they're downloaded and everything else is dropped, which
+        keeps memory use down for large accounts.
+
+        credentials is a callable that returns an (email, password) tuple, or
+        None if none are available. When it's given, the session is renewed
+        in the background once it's within refresh_ahead seconds of expiring,
+        so requests never have to wait for a login.
+
+        verify is passed to requests: a CA bundle path to check certificates
+        against, or False to skip the check. ssl_version is the TLS protocol
+        to use, which defaults to TLSv1. Both exist for testing against
+        local servers.
+        '''
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        if pool_connections is None:
+            pool_connections = default_pool_connections
+        if pool_maxsize is None:
+            pool_maxsize = default_pool_maxsize
+        if weather_cache is None:
+            weather_cache = shared_weather_cache(cache_dir)
+        if timeout is None:
+            timeout = default_timeout
+        if retries is None:
+            retries = default_retries
+        if breaker is None:
+            breaker = CircuitBreaker()
+        if refresh_ahead is None:
+            refresh_ahead = default_refresh_ahead
+        if ssl_version is None:
+            ssl_version = ssl.PROTOCOL_TLSv1
+
+        self._cache_dir = cache_dir
         self._session_file = '{}/session.json'.format(cache_dir)
+        self._session_lock_file = '{}/session.lock'.format(cache_dir)
+        self._status_file = '{}/status.json'.format(cache_dir)
+        self._status_ttl = status_ttl
         self._status = None
+        self._status_time = None
+        self._status_version = 0
+        self._status_lock = threading.RLock()
+        self._refreshing = False
+        self._refresh_lock = threading.Lock()
+        self._refresh_count = 0
+        self._partial_status = {}
+        self._local = threading.local()
+        self._subscribers = []
+        self._status_listeners = []
+        self._listener = None
         self._structures = None
         self._nests = None
         self._session = None
+        self._session_expiry = None
+        self._session_stamp = None
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._requestor = None
+        self._requestor_token = None
+        self._requestor_lock = threading.Lock()
+        self._weather_cache = weather_cache
+        self._instruments = list(instruments or [])
+        self._timeout = timeout
+        self._retries = retries
+        self._hedge_after = hedge_after
+        self._breaker = breaker
+        self._write_behind = write_behind
+        self._queued_writes = OrderedDict()
+        self._sending_writes = OrderedDict()
+        self._writes_changed = threading.Condition()
+        self._writer = None
+        self._status_fields = status_fields
+        self._credentials = credentials
+        self._refresh_ahead = refresh_ahead
+        self._verify = verify
+        self._ssl_version = ssl_version
+        self._refresh_in_thread = refresh_in_thread
+        self._next_detached_refresh = 0
+        self._snapshot_version = None
+        self._renew_lock = threading.Lock()
+        self._renewing = False
+        self._next_renewal = 0
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def weather_cache(self):
+        return self._weather_cache
+
+    def add_instrument(self, instrument):
+        '''Start reporting requests to an Instrument'''
+        self._instruments.append(instrument)
+
+    def remove_instrument(self, instrument):
+        '''Stop reporting requests to an Instrument'''
+        self._instruments.remove(instrument)
+
+    def _timing(self, name, elapsed):
+        for instrument in self._instruments:
+            instrument.timing(name, elapsed)
+
+    @property
+    def status_version(self):
+        '''A counter that changes whenever the status changes'''
+        return self._status_version
 
     @property
     def status(self):
+        if self._status is None and self._status_ttl is not None:
+            self._load_snapshot()
         if self._status is None:
-            r = self.request('GET', 'mobile/user.{}'.format(self.user_id))
-            self._status = r.json()
+            projection = getattr(self._local, 'projection', None)
+            if projection is not None:
+                return self.fetch_buckets(projection)
+            self.refresh()
+        elif (self._status_ttl is not None and
+              time() - self._status_time > self._status_ttl):
+            self._refresh_in_background()
         return self._status
 
+    def refresh(self):
+        '''Download the account status.
+
+        Only one refresh runs at a time. Callers that arrive while a refresh
+        is in flight wait for it and share its result.
+        '''
+        count = self._refresh_count
+        with self._refresh_lock:
+            if self._refresh_count != count:
+                return self._status
+
+            streaming = self._status_fields is not None
+            r = self.request('GET', 'mobile/user.{}'.format(self.user_id),
+                             hedge=True, stream=streaming)
+            start = time()
+            if streaming:
+                from nest_stream import parse_status
+                status = parse_status(r.iter_content(65536),
+                                      self._status_fields)
+            else:
+                status = r.json()
+            self._timing('parse', time() - start)
+            with self._status_lock:
+                self._status = status
+                self._status_time = time()
+                self._partial_status = {}
+                self._reapply_unsent_writes()
+                self._status_version += 1
+                self._save_snapshot()
+            self._refresh_count += 1
+        self._status_changed(None)
+        return status
+
+    @contextmanager
+    def projection(self, keys):
+        '''Only fetch the named buckets for status reads made in a block.
+
+        keys are bucket keys like "shared.<id>", "device.<id>" or
+        "structure.<id>". If the full status hasn't been loaded, status reads
+        in the block return a partial status holding just those buckets,
+        fetched on first use. Outside of a block the full status is loaded as
+        usual.
+        '''
+        outer = getattr(self._local, 'projection', None)
+        self._local.projection = list(keys) + list(outer or [])
+        try:
+            yield
+        finally:
+            self._local.projection = outer
+
+    def fetch_buckets(self, keys):
+        '''Fetch buckets that haven't been fetched yet into a partial status.
+
+        The buckets are requested from the subscribe endpoint with an unknown
+        revision, so Nest returns their current values right away.
+        '''
+        partial = self._partial_status
+        missing = []
+        for key in keys:
+            bucket, id = key.split('.', 1)
+            if id not in partial.get(bucket, {}):
+                missing.append(key)
+
+        if missing:
+            objects = [{'object_key': key, 'object_revision': 0,
+                        'object_timestamp': 0} for key in missing]
+            r = self.request('POST', 'subscribe', data={'objects': objects})
+            with self._status_lock:
+                for obj in r.json().get('objects', []):
+                    bucket, id = obj['object_key'].split('.', 1)
+                    value = obj.get('value', {})
+                    value['$version'] = obj.get('object_revision', 0)
+                    value['$timestamp'] = obj.get('object_timestamp', 0)
+                    partial.setdefault(bucket, {})[id] = value
+                self._status_version += 1
+            LOG.debug('fetched buckets %s', missing)
+
+        return partial
+
+    def _refresh_in_background(self):
+        '''Refresh a stale account status without making the caller wait'''
+        if not self._refresh_in_thread:
+            self._refresh_detached()
+            return
+
+        with self._status_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception:
+                LOG.exception('background status refresh failed')
+            finally:
+                self._refreshing = False
+
+        LOG.debug('refreshing stale status')
+        # not a daemon, so the refresh is finished even if the caller exits
+        thread = threading.Thread(target=refresh)
+        thread.start()
+
+    def _refresh_detached(self):
+        '''Refresh the status snapshot in a detached child process'''
+        if snapshot_version(self._status_file) != self._snapshot_version:
+            # a child process has saved a newer snapshot
+            self._load_snapshot()
+            if time() - self._status_time <= self._status_ttl:
+                return
+
+        now = time()
+        with self._status_lock:
+            if now < self._next_detached_refresh:
+                return
+            self._next_detached_refresh = now + self._status_ttl
+
+        import subprocess
+        import sys
+        options = {
+            'cache_dir': self._cache_dir,
+            'status_ttl': self._status_ttl,
+            'timeout': self._timeout,
+            'retries': self._retries,
+            'hedge_after': self._hedge_after,
+            'verify': self._verify,
+            'ssl_version': self._ssl_version,
+            'stale_time': self._status_time,
+        }
+        if self._status_fields is not None:
+            options['status_fields'] = dict(
+                (bucket, list(fields))
+                for bucket, fields in self._status_fields.items())
+
+        LOG.debug('refreshing stale status in a child process')
+        script = ('import sys; sys.path.insert(0, sys.argv[1]); '
+                  'import nest; nest._refresh_snapshot(sys.argv[2])')
+        try:
+            with open(devnull, 'r+') as null:
+                subprocess.Popen([sys.executable, '-c', script,
+                                  dirname(abspath(__file__)),
+                                  json.dumps(options)],
+                                 stdin=null, stdout=null, stderr=null,
+                                 close_fds=True, preexec_fn=setsid)
+        except Exception:
+            LOG.exception('unable to start a status refresh')
+
+    def update_status(self, bucket, id, values):
+        '''Apply values written to Nest to the cached status'''
+        self._apply_writes({(bucket, id): values})
+
+    def _apply_writes(self, writes):
+        '''Apply a set of bucket writes to the cached status at once'''
+        # the status is loaded first, since a refresh takes the status lock
+        # while holding the refresh lock
+        status = self.status
+        with self._status_lock:
+            if self._status is not None:
+                # a refresh may have replaced the status in the meantime
+                status = self._status
+            for (bucket, id), values in writes.items():
+                status.setdefault(bucket, {}).setdefault(id, {}).update(values)
+            self._status_version += 1
+            self._save_snapshot()
+        self._status_changed(list(writes))
+
+    def batch(self):
+        '''Collect writes into a single request.
+
+        Use the returned batch as a context manager; writes made by setters in
+        the block are sent together when it exits:
+
+            with account.batch():
+                structure.away = True
+                nest.fan = 'auto'
+        '''
+        return Batch(self)
+
+    @property
+    def _active_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_active_batch.setter
+    def _active_batch(self, batch):
+        self._local.batch = batch
+
+    def write(self, bucket, id, values):
+        '''Write values to a bucket, or queue them if a batch is active'''
+        batch = self._active_batch
+        if batch is not None:
+            batch.write(bucket, id, values)
+        else:
+            batch = Batch(self)
+            batch.write(bucket, id, values)
+            batch.commit()
+
+    def set_nests(self, target_temperature=None, mode=None, fan=None,
+                  overrides=None):
+        '''Set properties of every Nest in this account at once.
+
+        Values given as arguments apply to every Nest, and overrides maps
+        Nest IDs to {property: value} dicts that replace them for one Nest.
+        All the writes are sent in a single request. Returns a dict mapping
+        each Nest ID to None, or to the exception that kept it from being
+        set.
+        '''
+        return set_nests(self, self.nests.values(), target_temperature, mode,
+                         fan, overrides)
+
+    def set_away(self, away, overrides=None):
+        '''Set the away state of every structure in this account at once.
+
+        overrides maps structure IDs to their own away values. Returns a dict
+        mapping each structure ID to None or an exception, like set_nests.
+        '''
+        targets = []
+        for structure in self.structures.values():
+            value = (overrides or {}).get(structure.id, away)
+            targets.append((structure.id, structure, {'away': value}))
+        return _bulk_write(self, targets)
+
+    def _commit(self, writes):
+        '''Send a set of bucket writes, or queue them in write-behind mode'''
+        if self._write_behind:
+            self._apply_writes(writes)
+            with self._writes_changed:
+                for key, values in writes.items():
+                    self._queued_writes.setdefault(key, {}).update(values)
+                self._start_writer()
+                self._writes_changed.notify_all()
+        else:
+            self._post_writes(writes)
+            self._apply_writes(writes)
+
+    def _post_writes(self, writes):
+        '''POST a set of bucket writes to Nest in a single request'''
+        if len(writes) == 1:
+            (bucket, id), values = writes.items()[0]
+            self.request('POST', 'put/{}.{}'.format(bucket, id), data=values)
+        else:
+            data = {}
+            for (bucket, id), values in writes.items():
+                data.setdefault(bucket, {})[id] = values
+            self.request('POST', 'put', data=data)
+
+    def _reapply_unsent_writes(self):
+        '''Apply writes that haven't reached Nest yet over a new status'''
+        with self._writes_changed:
+            unsent = [self._sending_writes, self._queued_writes]
+            for writes in unsent:
+                for (bucket, id), values in writes.items():
+                    bucket_values = self._status.get(bucket, {}).get(id)
+                    if bucket_values is not None:
+                        bucket_values.update(values)
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._send_queued_writes)
+        self._writer.daemon = True
+        self._writer.start()
+        # the writer is a daemon thread, so nothing would wait for it
+        atexit.register(self._flush_at_exit)
+
+    def _flush_at_exit(self):
+        if not self.flush(self._timeout):
+            LOG.warn('exiting with unsent writes: %s', self._queued_writes)
+
+    def _send_queued_writes(self):
+        '''Send queued writes to Nest until the process exits'''
+        delay = default_retry_backoff
+        while True:
+            with self._writes_changed:
+                while not self._queued_writes:
+                    self._writes_changed.wait()
+                writes = self._queued_writes
+                self._sending_writes = writes
+                self._queued_writes = OrderedDict()
+
+            try:
+                self._post_writes(writes)
+                delay = default_retry_backoff
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                if response is not None and 400 <= response.status_code < 500:
+                    LOG.exception('dropping rejected writes %s', writes)
+                else:
+                    LOG.exception('unable to send writes; retrying')
+                    with self._writes_changed:
+                        # newer queued values win over the ones that failed
+                        for key, values in self._queued_writes.items():
+                            writes.setdefault(key, {}).update(values)
+                        self._queued_writes = writes
+                    sleep(delay)
+                    delay = min(delay * 2, 60)
+            finally:
+                with self._writes_changed:
+                    self._sending_writes = OrderedDict()
+                    self._writes_changed.notify_all()
+
+    def flush(self, timeout=None):
+        '''Wait for queued writes to be sent.
+
+        Returns False if writes are still waiting after timeout seconds.
+        '''
+        end = None if timeout is None else time() + timeout
+        with self._writes_changed:
+            while self._queued_writes or self._sending_writes:
+                if end is None:
+                    self._writes_changed.wait()
+                else:
+                    remaining = end - time()
+                    if remaining <= 0:
+                        return False
+                    self._writes_changed.wait(remaining)
+        return True
+
+    def _load_snapshot(self):
+        '''Load a saved status snapshot for the current user'''
+        self._snapshot_version = snapshot_version(self._status_file)
+        try:
+            with open(self._status_file, 'rt') as sfile:
+                snapshot = json.load(sfile)
+        except IOError:
+            return
+        except Exception:
+            LOG.exception('corrupt status snapshot')
+            return
+
+        if snapshot.get('userid') != self.user_id:
+            LOG.debug('ignoring status snapshot for another user')
+            return
+
+        with self._status_lock:
+            self._status = snapshot['status']
+            self._status_time = snapshot['time']
+            self._status_version += 1
+        self._status_changed(None)
+
+    def _save_snapshot(self):
+        '''Save the status to a snapshot file if snapshots are enabled'''
+        if self._status_ttl is None or self._status is None:
+            return
+
+        snapshot = {
+            'userid': self.user_id,
+            'time': self._status_time,
+            'status': self._status
+        }
+        try:
+            write_file_atomically(self._status_file, json.dumps(snapshot))
+            self._snapshot_version = snapshot_version(self._status_file)
+        except Exception:
+            LOG.exception('unable to save status snapshot')
+
+    # subscriptions ######################
+
+    def subscribe(self, callback):
+        '''Call callback(bucket, id, value) when a bucket changes on Nest'''
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        '''Remove a subscribed callback'''
+        self._subscribers.remove(callback)
+
+    def add_status_listener(self, listener):
+        '''Call listener(keys) whenever the cached status changes.
+
+        keys is a list of the (bucket, id) keys that may have changed, or None
+        if the whole status was replaced. Unlike subscribers, listeners also
+        hear about refreshes and local writes.
+        '''
+        self._status_listeners.append(listener)
+
+    def remove_status_listener(self, listener):
+        '''Remove a status listener'''
+        self._status_listeners.remove(listener)
+
+    def _status_changed(self, keys):
+        for listener in list(self._status_listeners):
+            try:
+                listener(keys)
+            except Exception:
+                LOG.exception('status listener failed')
+
+    def poll_changes(self, timeout=default_subscribe_timeout):
+        '''Wait for changed buckets and patch them into the status.
+
+        This long-polls the transport's subscribe endpoint with the revision
+        of every bucket in the status, so only buckets that changed on Nest
+        are returned. Returns a list of the (bucket, id) keys that changed.
+        '''
+        objects = []
+        for bucket, values in self.status.items():
+            for id, value in values.items():
+                if not isinstance(value, dict):
+                    continue
+                objects.append({
+                    'object_key': '{}.{}'.format(bucket, id),
+                    'object_revision': value.get('$version', 0),
+                    'object_timestamp': value.get('$timestamp', 0)
+                })
+
+        r = self.request('POST', 'subscribe', data={'objects': objects},
+                         timeout=timeout)
+
+        changed = []
+        for obj in r.json().get('objects', []):
+            bucket, id = obj['object_key'].split('.', 1)
+            value = obj.get('value', {})
+            value['$version'] = obj.get('object_revision', 0)
+            value['$timestamp'] = obj.get('object_timestamp', 0)
+            changed.append((bucket, id, value))
+
+        if changed:
+            with self._status_lock:
+                for bucket, id, value in changed:
+                    self._status.setdefault(bucket, {})[id] = value
+                    if bucket in ('user', 'structure'):
+                        self._structures = None
+                        self._nests = None
+                self._reapply_unsent_writes()
+                self._status_version += 1
+                self._save_snapshot()
+            self._status_changed([(bucket, id) for bucket, id, value
+                                  in changed])
+
+            for bucket, id, value in changed:
+                for callback in list(self._subscribers):
+                    try:
+                        callback(bucket, id, value)
+                    except Exception:
+                        LOG.exception('subscriber failed')
+
+        return [(bucket, id) for bucket, id, value in changed]
+
+    def listen(self, retry_delay=5):
+        '''Poll for changes in a background thread until stop_listening()'''
+        if self._listener is not None:
+            return
+
+        stop = threading.Event()
+
+        def listen():
+            delay = retry_delay
+            while not stop.is_set():
+                try:
+                    self.poll_changes()
+                    delay = retry_delay
+                except Exception:
+                    LOG.exception('polling for changes failed')
+                    stop.wait(delay)
+                    delay = min(delay * 2, 300)
+
+        thread = threading.Thread(target=listen)
+        thread.daemon = True
+        self._listener = (thread, stop)
+        thread.start()
+
+    def stop_listening(self):
+        '''Stop polling for changes'''
+        if self._listener is not None:
+            thread, stop = self._listener
+            self._listener = None
+            stop.set()
+
     @property
     def structures(self):
         if self._structures is None:
@@ -258,90 +1365,254 @@ class Account(object):
             self._nests = nests
         return self._nests
 
+    def nest(self, nest_id, structure_id=None):
+        '''Get one Nest by ID without creating every Nest in the account.
+
+        If the Nest's structure ID is given, the full status isn't needed to
+        find it; within a projection only the projected buckets are read to
+        check that it exists. KeyError is raised for unknown Nests.
+        '''
+        if self._nests is not None:
+            return self._nests[nest_id]
+        if structure_id is not None:
+            if self._structures is not None:
+                return self._structures[structure_id].nests[nest_id]
+            if not self._has_nest(nest_id, structure_id):
+                raise KeyError(nest_id)
+            return Nest(nest_id, Structure(structure_id, self))
+
+        device = 'device.{}'.format(nest_id)
+        for id, structure in self.status['structure'].items():
+            if device in structure.get('devices', ()):
+                return self.structures[id].nests[nest_id]
+
+        raise KeyError(nest_id)
+
+    def _has_nest(self, nest_id, structure_id):
+        device = 'device.{}'.format(nest_id)
+        projection = getattr(self._local, 'projection', None)
+        if projection is None or device in projection:
+            return nest_id in self.status.get('device', {})
+        # the structure bucket lists its devices, so a command that only
+        # reads the structure doesn't need the device bucket fetched
+        with self.projection(['structure.{}'.format(structure_id)]):
+            structure = self.status.get('structure', {}).get(structure_id)
+        return structure is not None and device in structure.get('devices',
+                                                                 ())
+
     @property
     def user_id(self):
         return self.session['userid']
 
     @property
     def session(self):
+        if self._session is None:
+            self._load_session()
         return self._session
 
     @property
     def has_session(self):
+        self._load_session()
+        expiry = self._session_expiry
+        if expiry is None:
+            return False
+        now = time()
+        if (self._credentials is not None and
+                expiry - now <= self._refresh_ahead):
+            self._renew_in_background()
+        return now <= expiry
+
+    @contextmanager
+    def _locked_session(self):
+        '''Hold an exclusive lock on the session file.
+
+        The lock is shared by every process and thread using the cache dir,
+        so only one of them logs in at a time.
+        '''
+        if not exists(self._cache_dir):
+            makedirs(self._cache_dir)
+        with open(self._session_lock_file, 'a') as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+
+    def _renew_in_background(self):
+        with self._renew_lock:
+            if self._renewing or time() < self._next_renewal:
+                return
+            self._renewing = True
+
+        # not a daemon, so a short-lived process still finishes the renewal
+        thread = threading.Thread(target=self._renew)
+        thread.start()
+
+    def _renew(self):
+        '''Log in again with the account's credentials'''
+        renewed = False
+        try:
+            with self._locked_session():
+                # another process may have renewed the session already
+                self._load_session()
+                expiry = self._session_expiry
+                if (expiry is not None and
+                        expiry - time() > self._refresh_ahead):
+                    renewed = True
+                    return
+                credentials = self._credentials()
+                if credentials is None:
+                    LOG.debug('no credentials to renew session with')
+                    return
+                LOG.info('renewing session')
+                renewed = self._login(*credentials)
+                if not renewed:
+                    LOG.warn('unable to renew session')
+        except Exception:
+            LOG.exception('error renewing session')
+        finally:
+            with self._renew_lock:
+                self._renewing = False
+                if not renewed:
+                    self._next_renewal = time() + default_renew_retry
+
+    def _load_session(self):
+        '''Read the session file if it changed since it was last read'''
+        try:
+            st = stat(self._session_file)
+        except OSError:
+            LOG.debug('missing session file')
+            self._set_session(None, None)
+            return
+
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        if stamp == self._session_stamp:
+            return
+
         try:
             with open(self._session_file, 'rt') as sfile:
-                self._session = json.load(sfile)
-                expiry = datetime.strptime(self.session['expires_in'],
-                                           '%a, %d-%b-%Y %H:%M:%S GMT')
-                if datetime.utcnow() <= expiry:
-                    return True
+                session = json.load(sfile)
         except Exception:
-            LOG.exception('missing or corrupt session file')
+            LOG.exception('corrupt session file')
+            session = None
+
+        self._set_session(session, stamp)
+
+    def _set_session(self, session, stamp):
+        '''Cache a session and its expiry time'''
+        expiry = None
+        if session is not None:
+            try:
+                expiry = timegm(datetime.strptime(
+                    session['expires_in'],
+                    '%a, %d-%b-%Y %H:%M:%S GMT').timetuple())
+            except Exception:
+                LOG.exception('invalid session expiry')
+                session = None
+
+        self._session = session
+        self._session_expiry = expiry
+        self._session_stamp = stamp
 
-        return False
+    @property
+    def requestor(self):
+        '''A pooled HTTP session for talking to Nest.
+
+        The session is shared by every request made through this account and
+        is only rebuilt when the access token changes.
+        '''
+        token = self.session['access_token']
+        with self._requestor_lock:
+            if self._requestor is None or self._requestor_token != token:
+                if self._requestor is not None:
+                    self._requestor.close()
+                import requests
+                adapter = tls_adapter(self._ssl_version,
+                                      pool_connections=self._pool_connections,
+                                      pool_maxsize=self._pool_maxsize)
+                requestor = requests.Session()
+                requestor.mount('https://', adapter)
+                requestor.headers.update({
+                    'User-Agent': user_agent,
+                    'Authorization': 'Basic ' + token,
+                    'X-nl-user-id': self.session['userid'],
+                    'X-nl-protocol-version': '1',
+                    'Accept-Language': 'en-us',
+                    'Connection': 'keep-alive',
+                    'Accept': '*/*'
+                })
+                self._requestor = requestor
+                self._requestor_token = token
+            return self._requestor
+
+    def close(self):
+        '''Close any open connections to Nest'''
+        with self._requestor_lock:
+            if self._requestor is not None:
+                self._requestor.close()
+                self._requestor = None
+                self._requestor_token = None
 
     def clear_session(self):
         '''Delete the session file'''
-        remove(self._session_file)
+        with self._locked_session():
+            remove(self._session_file)
+        self._set_session(None, None)
 
     def login(self, email, password):
         '''Login to the user's Nest account.'''
+        with self._locked_session():
+            return self._login(email, password)
 
-        # make the cache dir if it doesn't exist
-        cache_dir = dirname(self._session_file)
-        if not exists(cache_dir):
-            makedirs(cache_dir)
-
+    def _login(self, email, password):
         # authenticate with Nest and save the returned session data
+        import requests
+        start = time()
         res = requests.post(login_url, {'username': email,
-                                        'password': password})
+                                        'password': password},
+                            timeout=self._timeout, verify=self._verify)
+        self._timing('login', time() - start)
         if res.status_code != 200:
             return False
 
         session = res.json()
-        with open(self._session_file, 'wt') as sfile:
-            json.dump(session, sfile, indent=2)
-        self._session = session
+        write_file_atomically(self._session_file,
+                              json.dumps(session, indent=2))
+        st = stat(self._session_file)
+        self._set_session(session, (st.st_ino, st.st_mtime, st.st_size))
 
         return True
 
-    def request(self, method='GET', path='', data=None):
+    def request(self, method='GET', path='', data=None, timeout=None,
+                hedge=False, stream=False):
         '''GET from or POST to a user's Nest account.
 
-        This function requires a valid session to exist.
+        This function requires a valid session to exist. If stream is True,
+        the body of a successful GET is left to be read from the response.
         '''
         # check that we have a valid session
         if not self.has_session:
             raise NotAuthenticated('No session -- login first')
 
-        #from requests.utils import cookiejar_from_dict
-        self._requestor = requests.Session()
-        self._requestor.mount('https://', TlsAdapter())
-        self._requestor.headers.update({
-            'User-Agent': user_agent,
-            'Authorization': 'Basic ' + self.session['access_token'],
-            'X-nl-user-id': self.session['userid'],
-            'X-nl-protocol-version': '1',
-            'Accept-Language': 'en-us',
-            'Connection': 'keep-alive',
-            'Accept': '*/*'
-        })
-
         base_url = '{}/v2'.format(self.session['urls']['transport_url'])
         url = '{}/{}'.format(base_url, path)
+        endpoint = endpoint_name(path)
 
         if method == 'GET':
             LOG.info('GETting %s', url)
             # don't put headers it a status request
             if not url.endswith('.json'):
-                r = self._requestor.get(url)
+                r = self.send('GET', url, endpoint, timeout=timeout,
+                              hedge=hedge, stream=stream)
             else:
-                r = requests.get(url)
+                r = self.send('GET', url, endpoint, timeout=timeout,
+                              hedge=hedge, stream=stream,
+                              headers=anonymous_headers)
         elif method == 'POST':
             if not isinstance(data, (str, unicode)):
                 # convert data dicts to JSON strings
                 data = json.dumps(data)
-            r = self._requestor.post(url, data=data)
+            r = self.send('POST', url, endpoint, timeout=timeout, data=data)
         else:
             raise Exception('Invalid method "{}"'.format(method))
 
@@ -350,25 +1621,360 @@ class Account(object):
 
         return r
 
+    @contextmanager
+    def deadline(self, seconds):
+        '''Limit the total time requests made in a block may take.
+
+        Requests that would run past the deadline raise DeadlineExceeded.
+        Deadlines nest; the earliest one wins.
+        '''
+        outer = getattr(self._local, 'deadline', None)
+        deadline = time() + seconds
+        if outer is not None:
+            deadline = min(deadline, outer)
+        self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = outer
+
+    def send(self, method, url, endpoint=None, timeout=None, hedge=False,
+             **kwargs):
+        '''Send an HTTP request through this account's connection pool.
+
+        Requests are reported to the account's instruments under endpoint,
+        which defaults to the URL. GETs are retried, and hedged if hedge is
+        True and the account has a hedge delay.
+        '''
+        if endpoint is None:
+            endpoint = url
+        if timeout is None:
+            timeout = self._timeout
+        deadline = getattr(self._local, 'deadline', None)
+
+        def attempt():
+            return self._send_with_retries(method, url, endpoint, timeout,
+                                           deadline, kwargs)
+
+        if hedge and method == 'GET' and self._hedge_after is not None:
+            return self._hedged(attempt)
+        return attempt()
+
+    def _send_with_retries(self, method, url, endpoint, timeout, deadline,
+                           kwargs):
+        from requests import RequestException
+
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                r = self._send_once(method, url, endpoint, timeout, deadline,
+                                    kwargs)
+            except (CircuitOpen, DeadlineExceeded):
+                raise
+            except RequestException as e:
+                if method != 'GET' or tries > self._retries:
+                    raise
+                LOG.warn('retrying %s after error: %s', url, e)
+            else:
+                if (method != 'GET' or r.status_code < 500 or
+                        tries > self._retries):
+                    return r
+                LOG.warn('retrying %s after %s response', url, r.status_code)
+
+            delay = default_retry_backoff * 2 ** (tries - 1)
+            delay = random.uniform(delay / 2, delay)
+            if deadline is not None and time() + delay >= deadline:
+                raise DeadlineExceeded('No time left to retry {}'.format(url))
+            sleep(delay)
+
+    def _send_once(self, method, url, endpoint, timeout, deadline, kwargs):
+        if deadline is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise DeadlineExceeded('Deadline passed before {}'.format(
+                    url))
+            timeout = min(timeout, remaining) if timeout else remaining
+
+        host = urlparse(url).netloc
+        self._breaker.check(host)
+
+        instruments = self._instruments
+        for instrument in instruments:
+            instrument.before_request(method, endpoint, url)
+
+        start = time()
+        try:
+            # verify is passed with each request because requests prefers
+            # REQUESTS_CA_BUNDLE to a session's setting
+            r = self.requestor.request(method, url, timeout=timeout,
+                                       verify=self._verify, **kwargs)
+        except Exception as e:
+            self._breaker.record(host, False)
+            for instrument in instruments:
+                instrument.request_failed(method, endpoint, url, e,
+                                          time() - start)
+            raise
+
+        self._breaker.record(host, r.status_code < 500)
+
+        if instruments:
+            elapsed = time() - start
+            data = kwargs.get('data')
+            request_bytes = len(data) if isinstance(data, basestring) else 0
+            for instrument in instruments:
+                instrument.after_request(method, endpoint, url, request_bytes,
+                                         r, elapsed)
+        return r
+
+    def _hedged(self, attempt):
+        '''Run attempt, starting a second copy if the first is slow'''
+        results = Queue()
+
+        def run():
+            try:
+                results.put((True, attempt()))
+            except Exception as e:
+                results.put((False, e))
+
+        def start():
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        try:
+            ok, value = results.get(timeout=self._hedge_after)
+            pending = 0
+        except Empty:
+            LOG.debug('hedging slow request')
+            start()
+            ok, value = results.get()
+            pending = 1
+
+        if not ok and pending:
+            ok, value = results.get()
+        if not ok:
+            raise value
+        return value
+
+
+def _refresh_snapshot(options):
+    '''Refresh a stale status snapshot; run in a child process by Account.
+
+    options is the JSON the parent passed. Only one process refreshes a cache
+    dir's snapshot at a time, and nothing is done if another process has
+    already replaced the stale snapshot.
+    '''
+    options = json.loads(options)
+    stale_time = options.pop('stale_time')
+    if 'status_fields' in options:
+        options['status_fields'] = dict(
+            (bucket, set(fields))
+            for bucket, fields in options['status_fields'].items())
+    account = Account(**options)
+
+    with open('{}/refresh.lock'.format(account.cache_dir), 'a') as lfile:
+        try:
+            fcntl.flock(lfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        account._load_snapshot()
+        if account._status_time > stale_time:
+            return
+        account.refresh()
+
+
+# operations #########################
+
+# the Nest properties that operations can read and set; "away" and "weather"
+# come from the Nest's structure, and "status" reads everything at once
+readable_properties = ('name', 'scale', 'ip', 'humidity', 'temperature',
+                       'leaf', 'mode', 'fan', 'target_temperature')
+settable_properties = ('target_temperature', 'mode', 'fan', 'away')
+
+
+def find_nest(account, ref=None):
+    '''Find a Nest by ID or (case-insensitive) name.
+
+    The first Nest in the account is returned if ref is None.
+    '''
+    nests = account.nests
+    if ref is None:
+        return nests.values()[0]
+    if ref in nests:
+        return nests[ref]
+    for nest in nests.values():
+        if nest.name.lower() == ref.lower():
+            return nest
+    raise KeyError('No Nest with ID or name "{}"'.format(ref))
+
+
+def parse_operation(arg):
+    '''Parse a command line operation like "[NEST:]PROPERTY[=VALUE]".
+
+    Values are decoded as JSON where possible, so "21.5", "[19, 24]" and
+    "true" have their JSON types.
+    '''
+    operation = {}
+    target, sep, value = arg.partition('=')
+    if ':' in target:
+        operation['nest'], target = target.rsplit(':', 1)
+    if sep:
+        operation['set'] = target
+        try:
+            operation['value'] = json.loads(value)
+        except ValueError:
+            operation['value'] = value
+    else:
+        operation['get'] = target
+    return operation
+
+
+def _get_property(nest, name):
+    if name == 'away':
+        return nest.structure.away
+    if name == 'weather':
+        return nest.structure.weather
+    if name == 'status':
+        values = dict((n, getattr(nest, n)) for n in readable_properties)
+        values['away'] = nest.structure.away
+        return values
+    if name not in readable_properties:
+        raise KeyError('Unknown property "{}"'.format(name))
+    return getattr(nest, name)
+
+
+def _error_message(error):
+    '''The message for an operation's error result'''
+    if isinstance(error, KeyError):
+        # a KeyError's str() is the repr of its key
+        error = LookupError(*error.args)
+    try:
+        return unicode(error) or repr(error)
+    except UnicodeError:
+        return repr(error)
+
+
+def run_operations(account, operations, default_nest=None):
+    '''Run get and set operations, yielding a result for each one.
+
+    Each operation is a dict like {"get": "temperature"} or {"set": "fan",
+    "value": "on"}, or a line of JSON holding one, with an optional "nest" ID
+    or name and an optional "id" that's copied to its result. Results are
+    dicts with "ok" and either "value" or "error", yielded in the order the
+    operations were given; a line that isn't valid JSON gets an error result.
+
+    Runs of sets are merged and sent as one batch, which is committed before
+    the next get, or the next set of a property that's already pending, so
+    that every operation sees the ones before it. Pending sets are sent even
+    if reading operations or consuming results stops early.
+    '''
+    pending = []
+    targets = OrderedDict()
+
+    def flush():
+        if not pending:
+            return []
+        results = list(pending)
+        writes = [(id, obj, values) for id, (obj, values) in targets.items()]
+        del pending[:]
+        targets.clear()
+        try:
+            errors = _bulk_write(account, writes)
+        except Exception as e:
+            LOG.exception('unable to send sets')
+            errors = dict((id, e) for id, obj, values in writes)
+        for result, id in results:
+            if id is not None:
+                result['ok'] = errors.get(id) is None
+                if not result['ok']:
+                    result['error'] = _error_message(errors[id])
+        return [result for result, id in results]
+
+    try:
+        for operation in operations:
+            result = OrderedDict()
+            try:
+                if isinstance(operation, basestring):
+                    operation = json.loads(operation)
+                if 'id' in operation:
+                    result['id'] = operation['id']
+                nest = find_nest(account, operation.get('nest', default_nest))
+                result['nest'] = nest.id
+                if 'set' in operation:
+                    name = operation['set']
+                    result['set'] = name
+                    if name not in settable_properties:
+                        raise KeyError('Property "{}" can\'t be '
+                                       'set'.format(name))
+                    obj = nest.structure if name == 'away' else nest
+                    value = operation['value']
+                    if isinstance(value, list):
+                        value = tuple(value)
+                    if name in targets.get(obj.id, (obj, {}))[1]:
+                        # send the earlier value rather than replacing it
+                        for done in flush():
+                            yield done
+                    targets.setdefault(obj.id, (obj, {}))[1][name] = value
+                    pending.append((result, obj.id))
+                    continue
+
+                for done in flush():
+                    yield done
+                name = operation.get('get', 'status')
+                result['get'] = name
+                result['value'] = _get_property(nest, name)
+                result['ok'] = True
+            except Exception as e:
+                result['ok'] = False
+                result['error'] = _error_message(e)
+            if pending:
+                # keep results in order behind the sets waiting to be sent
+                pending.append((result, None))
+            else:
+                yield result
+
+        for done in flush():
+            yield done
+    finally:
+        # the results of these sets can't be reported any more, but the
+        # values that were accepted are still sent
+        flush()
+
 
 if __name__ == '__main__':
+    import sys
     from argparse import ArgumentParser
-    parser = ArgumentParser()
-    parser.add_argument('property', help='Property to get or set',
-                        choices=('ip', 'status', 'temperature', 'humidity',
-                                 'target_temperature', 'away', 'leaf',
-                                 'weather'))
-    parser.add_argument('value', nargs='?', help='Value to set')
+    parser = ArgumentParser(
+        description='Get and set Nest properties. Operations are given as '
+        'arguments or, with no arguments, as JSON objects on stdin, one per '
+        'line. One JSON result is printed per operation.',
+        epilog='Properties: {}, away, weather, status'.format(
+            ', '.join(readable_properties)))
+    parser.add_argument('operations', nargs='*',
+                        metavar='[NEST:]PROPERTY[=VALUE]',
+                        help='Get a property, or set it to VALUE')
+    parser.add_argument('--nest', help='ID or name of the Nest to use when '
+                        'an operation doesn\'t name one')
+    parser.add_argument('--cache-dir', help='Account cache dir')
     args = parser.parse_args()
 
-    nest = Nest()
-
-    from pprint import pprint
-    if hasattr(nest, args.property):
-        pprint(getattr(nest, args.property))
-    elif args.property in globals():
-        globals()[args.property]()
-
-    if args.value:
-        print 'Setting {} to {}'.format(args.property, args.value)
-        setattr(nest, args.property, args.value)
+    if args.operations:
+        operations = (parse_operation(arg) for arg in args.operations)
+    else:
+        # lines are decoded one at a time, so a bad line only fails itself
+        operations = (line for line in iter(sys.stdin.readline, '')
+                      if line.strip())
+
+    account = Account(cache_dir=args.cache_dir)
+    if not account.has_session:
+        raise SystemExit('No session -- login first')
+
+    failed = False
+    for result in run_operations(account, operations, args.nest):
+        failed = failed or not result['ok']
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+    account.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,342 @@
+'''Compute statistics over archived Nest status snapshots with NumPy.
+
+    frame = load('/archive/status', weather='/archive/weather')
+    print frame.summary()
+
+Snapshots are JSON files holding either a raw mobile/user status response or
+a status snapshot saved by Account ({"userid", "time", "status"}). Files are
+decoded in parallel worker processes into one row per Nest per snapshot, using
+the same field mapping as Nest (nest.nest_fields), and collected into column
+arrays. Statistics are then computed for every Nest at once.
+
+Each row is weighted by the time until the Nest's next row, capped at
+max_gap seconds, so gaps in the archive don't count as time spent in the last
+recorded state. Temperatures are in Celsius.
+'''
+
+import json
+import logging
+from multiprocessing import Pool
+from os import listdir
+from os.path import basename, getmtime, isdir, join, splitext
+from urllib import unquote
+
+import numpy as np
+
+from nest import nest_fields
+
+
+LOG = logging.getLogger(__name__)
+
+# the longest time, in seconds, that one row is assumed to last
+default_max_gap = 3600
+
+# degrees Celsius a temperature can be from its target and still count as
+# being at the target
+default_tolerance = 1.0
+
+# files are handed to worker processes in chunks of this many
+default_chunk_size = 16
+
+modes = {'off': 0, 'heat': 1, 'cool': 2, 'range': 3}
+
+# (column, nest_fields name) for the numeric Nest fields that are loaded
+numeric_fields = (
+    ('temperature', 'temperature'),
+    ('target', 'target_temperature'),
+    ('target_low', 'target_temperature_low'),
+    ('target_high', 'target_temperature_high'),
+    ('humidity', 'humidity'),
+)
+
+# every per-row column, in the order rows are built
+row_columns = (tuple(c for c, f in numeric_fields) +
+               ('mode', 'fan', 'leaf', 'away'))
+
+nan = float('nan')
+
+
+def _number(value):
+    try:
+        return nan if value is None else float(value)
+    except (TypeError, ValueError):
+        return nan
+
+
+def _flag(value):
+    return nan if value is None else float(bool(value))
+
+
+def _field(status, name, id):
+    bucket, key = nest_fields[name]
+    return status.get(bucket, {}).get(id, {}).get(key)
+
+
+def _snapshot_paths(source):
+    if isinstance(source, basestring):
+        if isdir(source):
+            return sorted(join(source, name) for name in listdir(source)
+                          if name.endswith('.json'))
+        return [source]
+    return list(source)
+
+
+def load_snapshot(path):
+    '''Decode one snapshot file into (time, rows).
+
+    rows is a list of (device id, structure id, postal code, values) tuples,
+    where values follows row_columns.
+    '''
+    try:
+        with open(path, 'rt') as sfile:
+            data = json.load(sfile)
+    except Exception:
+        LOG.exception('unreadable snapshot %s', path)
+        return None, []
+
+    if 'status' in data and 'time' in data:
+        when, status = data['time'], data['status']
+    else:
+        when, status = getmtime(path), data
+
+    rows = []
+    for structure_id, structure in status.get('structure', {}).items():
+        away = _flag(structure.get('away'))
+        postal_code = structure.get('postal_code')
+        for device in structure.get('devices', ()):
+            id = device.split('.', 1)[1]
+            values = [_number(_field(status, name, id))
+                      for column, name in numeric_fields]
+            mode = _field(status, 'mode', id)
+            values.append(modes.get((mode or '').lower(), nan))
+            fan = _field(status, 'fan', id)
+            values.append(nan if fan is None else float(fan == 'on'))
+            values.append(_flag(_field(status, 'leaf', id)))
+            values.append(away)
+            rows.append((id, structure_id, postal_code, values))
+    return when, rows
+
+
+def load_weather_file(path):
+    '''Decode an archived weather report into (time, location, temp_c).
+
+    Files hold either an entry saved by WeatherCache (named for the quoted
+    location) or a raw weather response ({location: report}).
+    '''
+    try:
+        with open(path, 'rt') as wfile:
+            data = json.load(wfile)
+        if 'data' in data and 'time' in data:
+            when, report = data['time'], data['data']
+            location = unquote(splitext(basename(path))[0])
+        else:
+            when = getmtime(path)
+            location, report = data.items()[0]
+        return when, location, float(report['current']['temp_c'])
+    except Exception:
+        LOG.exception('unreadable weather report %s', path)
+        return None
+
+
+class Frame(object):
+    '''Column arrays of Nest readings, sorted by Nest and then time.
+
+    devices and structures list the IDs that the device and structure
+    columns index into.
+    '''
+
+    def __init__(self, columns, devices, structures, max_gap=None):
+        if max_gap is None:
+            max_gap = default_max_gap
+        self.devices = devices
+        self.structures = structures
+        self.columns = columns
+        self.max_gap = max_gap
+
+        device = columns['device']
+        time = columns['time']
+        # each row lasts until the Nest's next row, up to max_gap
+        duration = np.zeros(len(time))
+        if len(time):
+            duration[:-1] = np.diff(time)
+            last = np.ones(len(time), dtype=bool)
+            last[:-1] = device[1:] != device[:-1]
+            duration[last] = 0
+            np.clip(duration, 0, max_gap, out=duration)
+        self.columns['duration'] = duration
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def _per_device(self, values, weights=None):
+        '''Sum values (and weights) for each Nest'''
+        count = len(self.devices)
+        device = self['device']
+        if weights is None:
+            return np.bincount(device, values, minlength=count)
+        return (np.bincount(device, values * weights, minlength=count),
+                np.bincount(device, weights, minlength=count))
+
+    def _ratio(self, mask, valid):
+        '''The fraction of each Nest's valid time for which mask is true'''
+        duration = np.where(valid, self['duration'], 0.0)
+        hits, total = self._per_device(mask.astype(float), duration)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return hits / total
+
+    def tracked_time(self):
+        '''Seconds of recorded time for each Nest'''
+        return self._per_device(self['duration'])
+
+    def adherence(self, tolerance=None):
+        '''The fraction of time each Nest was within tolerance of its target.
+
+        In range mode the temperature only has to be between the low and high
+        targets. Rows in off mode, or without a temperature or target, aren't
+        counted.
+        '''
+        if tolerance is None:
+            tolerance = default_tolerance
+        temp = self['temperature']
+        mode = self['mode']
+        in_range = mode == modes['range']
+        low = np.where(in_range, self['target_low'], self['target'])
+        high = np.where(in_range, self['target_high'], self['target'])
+        valid = ((mode > 0) & ~np.isnan(temp) & ~np.isnan(low) &
+                 ~np.isnan(high))
+        with np.errstate(invalid='ignore'):
+            within = (temp >= low - tolerance) & (temp <= high + tolerance)
+        return self._ratio(within, valid)
+
+    def away_time(self):
+        '''Seconds each Nest's structure was in away mode'''
+        away = np.nan_to_num(self['away'])
+        return self._per_device(away * self['duration'])
+
+    def fan_duty(self):
+        '''The fraction of time each Nest's fan was forced on'''
+        fan = self['fan']
+        return self._ratio(fan == 1, ~np.isnan(fan))
+
+    def outdoor_delta(self):
+        '''The time-weighted mean indoor minus outdoor temperature per Nest'''
+        delta = self['temperature'] - self['outdoor']
+        valid = ~np.isnan(delta)
+        totals, weights = self._per_device(np.where(valid, delta, 0.0),
+                                           np.where(valid, self['duration'],
+                                                    0.0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return totals / weights
+
+    def summary(self, tolerance=None):
+        '''Every statistic, as {device id: {name: value}}'''
+        stats = (
+            ('tracked_time', self.tracked_time()),
+            ('adherence', self.adherence(tolerance)),
+            ('away_time', self.away_time()),
+            ('fan_duty', self.fan_duty()),
+            ('outdoor_delta', self.outdoor_delta()),
+        )
+        summary = {}
+        for index, device in enumerate(self.devices):
+            summary[device] = dict(
+                (name, None if np.isnan(values[index])
+                 else float(values[index]))
+                for name, values in stats)
+        return summary
+
+
+def _outdoor(times, codes, reports):
+    '''Find the latest outdoor temperature at or before each row'''
+    outdoor = np.empty(len(times))
+    outdoor.fill(nan)
+    by_location = {}
+    for when, location, temp in reports:
+        by_location.setdefault(location, []).append((when, temp))
+    for location, readings in by_location.items():
+        readings.sort()
+        report_times = np.array([r[0] for r in readings])
+        report_temps = np.array([r[1] for r in readings])
+        rows = np.nonzero(codes == location)[0]
+        index = np.searchsorted(report_times, times[rows], side='right') - 1
+        found = index >= 0
+        outdoor[rows[found]] = report_temps[index[found]]
+    return outdoor
+
+
+def load(snapshots, weather=None, processes=None, max_gap=None):
+    '''Load snapshot files into a Frame.
+
+    snapshots and weather are each a directory of .json files or a list of
+    paths. Files are decoded by a pool of `processes` worker processes
+    (defaulting to one per CPU).
+    '''
+    paths = _snapshot_paths(snapshots)
+    pool = Pool(processes)
+    try:
+        loaded = pool.map(load_snapshot, paths, default_chunk_size)
+        reports = []
+        if weather is not None:
+            reports = [r for r in pool.map(load_weather_file,
+                                           _snapshot_paths(weather),
+                                           default_chunk_size)
+                       if r is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    devices = {}
+    structures = {}
+    times = []
+    device_index = []
+    structure_index = []
+    postal_codes = []
+    values = []
+    for when, rows in loaded:
+        if when is None:
+            continue
+        for id, structure_id, postal_code, row in rows:
+            times.append(when)
+            device_index.append(devices.setdefault(id, len(devices)))
+            structure_index.append(structures.setdefault(structure_id,
+                                                         len(structures)))
+            postal_codes.append(postal_code)
+            values.append(row)
+    LOG.debug('loaded %d rows from %d files', len(times), len(paths))
+
+    times = np.array(times, dtype=float)
+    device_index = np.array(device_index, dtype=int)
+    order = np.lexsort((times, device_index))
+    values = np.array(values, dtype=float).reshape(len(order),
+                                                   len(row_columns))
+
+    columns = {
+        'time': times[order],
+        'device': device_index[order],
+        'structure': np.array(structure_index, dtype=int)[order],
+    }
+    for i, name in enumerate(row_columns):
+        columns[name] = values[order, i]
+    columns['outdoor'] = _outdoor(columns['time'],
+                                  np.array(postal_codes, dtype=object)[order],
+                                  reports)
+
+    return Frame(columns, sorted(devices, key=devices.get),
+                 sorted(structures, key=structures.get), max_gap)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Summarize archived Nest status '
+                            'snapshots')
+    parser.add_argument('snapshots', help='Directory of status snapshots')
+    parser.add_argument('--weather', help='Directory of weather reports')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--tolerance', type=float)
+    args = parser.parse_args()
+
+    frame = load(args.snapshots, args.weather, args.processes)
+    print json.dumps(frame.summary(args.tolerance), indent=2, sort_keys=True)
@@ -0,0 +1,165 @@
+'''A non-blocking interface to Nest accounts, built on gevent.
+
+gevent is required, and its monkey patches must be applied before nest, or
+requests, is imported:
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    import nest
+    from nest_async import AsyncAccount, gather
+
+    accounts = [AsyncAccount(nest.Account(cache_dir=d)) for d in dirs]
+    statuses = gather([a.refresh() for a in accounts], 60)
+
+Every method starts its work in a greenlet and returns right away with a
+pending result; call get(timeout=...) on it to wait for the value, or ready()
+to check whether it's done. With sockets patched, requests waiting on the
+network yield to other greenlets, so a single thread can have as many
+requests in flight as there are greenlets in the pool. Each account's
+requests go through its own connection pool.
+
+Python 2 has no asyncio, so there are no coroutines to await; this is the
+nearest equivalent, and it doesn't tie up a thread per request.
+'''
+
+import logging
+
+import gevent
+from gevent import monkey
+from gevent.pool import Pool
+
+
+LOG = logging.getLogger(__name__)
+
+if not monkey.is_module_patched('socket'):
+    raise ImportError('nest_async needs gevent.monkey.patch_all() to be '
+                      'called before nest is imported')
+
+default_concurrency = 1000
+
+_pool = None
+
+
+def pool(size=None):
+    '''Get the shared greenlet pool, creating it with room for `size`'''
+    global _pool
+    if _pool is None:
+        _pool = Pool(size or default_concurrency)
+    return _pool
+
+
+def submit(func, *args, **kwargs):
+    '''Run func in a greenlet and return its pending result.
+
+    This only waits if the pool is full.
+    '''
+    return pool().spawn(func, *args, **kwargs)
+
+
+def gather(results, timeout=None):
+    '''Wait for a list of pending results and return their values'''
+    gevent.joinall(results, timeout=timeout)
+    return [result.get(block=False) for result in results]
+
+
+class AsyncNest(object):
+    '''Non-blocking access to a Nest.'''
+
+    def __init__(self, nest):
+        self._nest = nest
+
+    @property
+    def id(self):
+        return self._nest.id
+
+    def get(self, name):
+        '''Read a property, refreshing the status first if it's needed'''
+        return submit(getattr, self._nest, name)
+
+    def snapshot(self):
+        '''Read every property at once'''
+        return submit(lambda: self._nest.snapshot)
+
+    def set(self, **values):
+        '''Set properties (mode, fan, target_temperature) in one request'''
+        return submit(self._set, values)
+
+    def _set(self, values):
+        from nest import set_nests
+        error = set_nests(self._nest.account, [self._nest],
+                          **values)[self._nest.id]
+        if error is not None:
+            raise error
+
+
+class AsyncStructure(object):
+    '''Non-blocking access to a Structure.'''
+
+    def __init__(self, structure):
+        self._structure = structure
+
+    @property
+    def id(self):
+        return self._structure.id
+
+    def nest(self, nest_id):
+        '''A pending AsyncNest'''
+        return submit(lambda: AsyncNest(self._structure.nests[nest_id]))
+
+    def weather(self):
+        return submit(lambda: self._structure.weather)
+
+    def away(self):
+        return submit(lambda: self._structure.away)
+
+    def set_away(self, away):
+        return submit(setattr, self._structure, 'away', away)
+
+    def set_nests(self, **values):
+        return submit(self._structure.set_nests, **values)
+
+
+class AsyncAccount(object):
+    '''Non-blocking access to an Account.
+
+    Methods are safe to call concurrently; status downloads are shared by
+    callers that overlap (see Account.refresh).
+    '''
+
+    def __init__(self, account):
+        self._account = account
+
+    @property
+    def account(self):
+        return self._account
+
+    def login(self, email, password):
+        return submit(self._account.login, email, password)
+
+    def refresh(self):
+        return submit(self._account.refresh)
+
+    def status(self):
+        return submit(lambda: self._account.status)
+
+    def structures(self):
+        '''A pending list of AsyncStructures'''
+        return submit(lambda: [AsyncStructure(s) for s in
+                               self._account.structures.values()])
+
+    def structure(self, structure_id):
+        '''A pending AsyncStructure'''
+        return submit(lambda: AsyncStructure(
+            self._account.structures[structure_id]))
+
+    def nest(self, nest_id, structure_id=None):
+        '''A pending AsyncNest; its status buckets may have to be fetched'''
+        return submit(lambda: AsyncNest(self._account.nest(nest_id,
+                                                           structure_id)))
+
+    def set_nests(self, **values):
+        return submit(self._account.set_nests, **values)
+
+    def request(self, method='GET', path='', data=None):
+        return submit(self._account.request, method, path, data)
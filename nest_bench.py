@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+'''Benchmark the Nest client against a local stand-in for the Nest service.
+
+The stand-in server implements the parts of the Nest API that this package
+uses, serves a synthetic account of a configurable size, and can add a fixed
+latency to every response.
+'''
+
+import json
+import logging
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+from os import remove
+from os.path import abspath, dirname, exists, join
+from tempfile import mkdtemp
+from time import sleep, time
+
+import nest as nestlib
+
+
+LOG = logging.getLogger(__name__)
+
+user_id = '1000'
+
+
+def synthetic_status(structures=1, devices=1):
+    '''Build a status blob with `devices` Nests in each of `structures`'''
+    status = {'user': {}, 'structure': {}, 'device': {}, 'shared': {},
+              'metadata': {}, 'link': {}}
+    struct_keys = []
+    for s in range(structures):
+        sid = 'struct{:04d}'.format(s)
+        struct_keys.append('structure.' + sid)
+        device_keys = []
+        for d in range(devices):
+            did = '{:04d}{:08d}'.format(s, d)
+            device_keys.append('device.' + did)
+            status['device'][did] = {
+                'temperature_scale': 'F' if d % 2 else 'C',
+                'current_humidity': 40 + d % 20,
+                'leaf': bool(d % 3),
+                'current_schedule_mode': 'RANGE' if d % 4 == 0 else 'HEAT',
+                'fan_mode': 'auto',
+            }
+            status['shared'][did] = {
+                'name': 'Thermostat {} {}'.format(s, d),
+                'current_temperature': 18.0 + d % 8,
+                'target_temperature': 21.0,
+                'target_temperature_low': 19.0,
+                'target_temperature_high': 24.0,
+            }
+            status['metadata'][did] = {'last_ip': '10.0.{}.{}'.format(
+                s % 256, d % 256)}
+            status['link'][did] = {'structure': 'structure.' + sid}
+        status['structure'][sid] = {
+            'name': 'Home {}'.format(s),
+            'away': False,
+            'postal_code': '{:05d}'.format(10000 + s),
+            'devices': device_keys,
+        }
+    status['user'][user_id] = {'structures': struct_keys}
+
+    for bucket in status.values():
+        for value in bucket.values():
+            value['$version'] = 1
+            value['$timestamp'] = int(time() * 1000)
+    return status
+
+
+def synthetic_weather(location):
+    daily = {'condition': 'sunny', 'temp_high_c': 25.0, 'temp_low_c': 12.0,
+             'temp_high_f': 77.0, 'temp_low_f': 53.6}
+    return {location: {
+        'current': {'condition': 'sunny', 'temp_c': 20.0, 'temp_f': 68.0,
+                    'humidity': 50},
+        'forecast': {'daily': [daily, daily]},
+    }}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write so keep-alive clients aren't stalled
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+    def _send(self, code, data=None):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        server = self.server
+        sleep(server.latency)
+        path = self.path
+
+        if path.startswith('/v2/mobile/user.'):
+            if not self._authorized():
+                return
+            with server.lock:
+                self._send(200, server.status)
+        elif path.startswith('/weather/'):
+            self._send(200, synthetic_weather(path[len('/weather/'):]))
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        server = self.server
+        sleep(server.latency)
+        path = self.path
+        body = self._body()
+
+        if path == '/user/login':
+            self._send(200, server.session)
+        elif path == '/v2/put':
+            if not self._authorized():
+                return
+            with server.lock:
+                for bucket, values in json.loads(body).items():
+                    for id, value in values.items():
+                        server.write(bucket, id, value)
+            self._send(200, {})
+        elif path.startswith('/v2/put/'):
+            if not self._authorized():
+                return
+            bucket, id = path[len('/v2/put/'):].split('.', 1)
+            with server.lock:
+                server.write(bucket, id, json.loads(body))
+            self._send(200, {})
+        elif path == '/v2/subscribe':
+            if not self._authorized():
+                return
+            self._send(200, {'objects': server.changes(
+                json.loads(body).get('objects', []))})
+        else:
+            self._send(404)
+
+    def _authorized(self):
+        token = self.headers.getheader('Authorization')
+        if token != 'Basic ' + self.server.session['access_token']:
+            self._send(401, {'error': 'unauthorized'})
+            return False
+        return True
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    '''A local server that behaves like the parts of Nest this package uses'''
+
+    daemon_threads = True
+    # concurrent clients shouldn't be left waiting to connect
+    request_queue_size = 64
+
+    def __init__(self, structures=1, devices=1, latency=0.0, port=0,
+                 certfile=None, keyfile=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.status = synthetic_status(structures, devices)
+        self.writes = 0
+
+        scheme = 'http'
+        if certfile:
+            scheme = 'https'
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile,
+                                          keyfile=keyfile, server_side=True)
+
+        self.url = '{}://127.0.0.1:{}'.format(scheme, self.server_address[1])
+        expires = datetime.utcnow() + timedelta(days=30)
+        self.session = {
+            'access_token': 'bench-token',
+            'userid': user_id,
+            'expires_in': expires.strftime('%a, %d-%b-%Y %H:%M:%S GMT'),
+            'urls': {
+                'transport_url': self.url,
+                'weather_url': self.url + '/weather/',
+            },
+        }
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        # clients closing pooled connections when they exit aren't errors
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def write(self, bucket, id, values):
+        value = self.status.setdefault(bucket, {}).setdefault(id, {})
+        value.update(values)
+        value['$version'] = value.get('$version', 0) + 1
+        value['$timestamp'] = int(time() * 1000)
+        self.writes += 1
+
+    def changes(self, objects):
+        changed = []
+        with self.lock:
+            for obj in objects:
+                bucket, id = obj['object_key'].split('.', 1)
+                value = self.status.get(bucket, {}).get(id)
+                if value is None:
+                    continue
+                if value.get('$version') != obj.get('object_revision'):
+                    changed.append({
+                        'object_key': obj['object_key'],
+                        'object_revision': value['$version'],
+                        'object_timestamp': value['$timestamp'],
+                        'value': value,
+                    })
+        return changed
+
+    def start(self):
+        '''Serve requests in a background thread'''
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def percentiles(times, points=(50, 90, 99)):
+    '''Summarize a list of durations in milliseconds'''
+    times = sorted(times)
+    summary = {'n': len(times)}
+    if times:
+        for point in points:
+            index = min(len(times) - 1, int(len(times) * point / 100.0))
+            summary['p{}'.format(point)] = round(times[index] * 1000, 3)
+        summary['mean'] = round(sum(times) / len(times) * 1000, 3)
+    return summary
+
+
+def timed(func, iterations):
+    times = []
+    for i in range(iterations):
+        start = time()
+        func()
+        times.append(time() - start)
+    return percentiles(times)
+
+
+# the workflow commands that are timed, each with an empty query
+workflow_commands = ('tell_status', 'tell_target', 'tell_fan', 'tell_away',
+                     'tell_mode', 'tell_nest', 'tell_weather')
+
+workflow_script = '''
+import sys
+from functools import partial
+import alfred_nest
+alfred_nest.nestlib.Account = partial(alfred_nest.nestlib.Account,
+                                      **{account_args!r})
+
+class BenchWorkflow(alfred_nest.NestWorkflow):
+    cache_dir = property(lambda self: {cache_dir!r}, lambda self, value: None)
+
+getattr(BenchWorkflow(), sys.argv[1])(u'')
+'''
+
+
+def _run_script(script, *args):
+    env_dir = dirname(abspath(__file__))
+    start = time()
+    subprocess.check_call([sys.executable, '-c', script] + list(args),
+                          cwd=env_dir)
+    return time() - start
+
+
+def cold_start(cache_dir, iterations, account_args):
+    '''Time a fresh process that imports nest and loads the status'''
+    script = ('import nest; '
+              'a = nest.Account(cache_dir={!r}, **{!r}); a.has_session; '
+              'a.status').format(cache_dir, account_args)
+    return percentiles([_run_script(script) for i in range(iterations)])
+
+
+def workflow(cache_dir, iterations, account_args):
+    '''Time each workflow command in a fresh process, as Alfred runs them.
+
+    Each command is timed with an empty result cache ("miss") and then again
+    with the results it just cached ("hit").
+    '''
+    try:
+        subprocess.check_call([sys.executable, '-c', 'import jcalfred'],
+                              cwd=dirname(abspath(__file__)))
+    except subprocess.CalledProcessError:
+        return 'not run: jcalfred is not installed'
+
+    script = workflow_script.format(cache_dir=cache_dir,
+                                    account_args=account_args)
+    results_file = join(cache_dir, 'results.json')
+    results = {}
+    for command in workflow_commands:
+        misses = []
+        hits = []
+        for i in range(iterations):
+            if exists(results_file):
+                remove(results_file)
+            misses.append(_run_script(script, command))
+            hits.append(_run_script(script, command))
+        results[command] = {'miss': percentiles(misses),
+                            'hit': percentiles(hits)}
+    return results
+
+
+def run(structures=1, devices=1, latency=0.0, iterations=20, writes=100,
+        certfile=None, keyfile=None, verify=None):
+    '''Run the benchmarks and return a dict of results.
+
+    With a certfile the stand-in serves TLS. verify is passed to the
+    accounts and defaults to certfile, which must then be valid for
+    127.0.0.1; pass False to skip certificate checks.
+    '''
+    server = StandInServer(structures, devices, latency, certfile=certfile,
+                           keyfile=keyfile).start()
+    cache_dir = mkdtemp(prefix='nest-bench-')
+    saved_login_url = nestlib.login_url
+    nestlib.login_url = server.url + '/user/login'
+    results = {'structures': structures, 'devices': devices,
+               'latency': latency}
+
+    account_args = {}
+    if certfile:
+        account_args['verify'] = certfile if verify is None else verify
+        # the stand-in uses whatever TLS version the local OpenSSL prefers
+        account_args['ssl_version'] = ssl.PROTOCOL_SSLv23
+
+    try:
+        account = nestlib.Account(cache_dir=cache_dir, **account_args)
+        results['login'] = timed(
+            lambda: account.login('bench@example.com', 'bench'), 1)
+        results['cold_start'] = cold_start(cache_dir, max(1, iterations // 4),
+                                           account_args)
+        results['workflow'] = workflow(cache_dir, max(1, iterations // 4),
+                                       account_args)
+        results['status'] = timed(account.refresh, iterations)
+
+        nest = account.nests.values()[0]
+        results['read'] = timed(lambda: (nest.temperature,
+                                         nest.target_temperature,
+                                         nest.humidity, nest.fan,
+                                         nest.mode, nest.structure.away),
+                                iterations * 100)
+        results['weather'] = timed(lambda: nest.structure.weather,
+                                   iterations)
+
+        fans = ['on', 'auto']
+        start = time()
+        for i in range(writes):
+            nest.fan = fans[i % 2]
+        elapsed = time() - start
+        results['write_throughput'] = round(writes / elapsed, 2)
+
+        nests = account.nests.values()
+        start = time()
+        for i in range(max(1, writes // len(nests))):
+            with account.batch():
+                for n in nests:
+                    n.fan = fans[i % 2]
+        elapsed = time() - start
+        results['batched_write_throughput'] = round(
+            max(1, writes // len(nests)) * len(nests) / elapsed, 2)
+
+        results['server_writes'] = server.writes
+        account.close()
+    finally:
+        nestlib.login_url = saved_login_url
+        server.stop()
+
+    return results
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark the Nest client against '
+                            'a local stand-in server')
+    parser.add_argument('--structures', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=1,
+                        help='Nests per structure')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to delay each response')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--writes', type=int, default=100)
+    parser.add_argument('--certfile', help='Serve over TLS with this cert')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--insecure', action='store_true',
+                        help="Don't verify the stand-in's certificate")
+    args = parser.parse_args()
+
+    print json.dumps(run(args.structures, args.devices, args.latency,
+                         args.iterations, args.writes, args.certfile,
+                         args.keyfile, False if args.insecure else None),
+                     indent=2, sort_keys=True)
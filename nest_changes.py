@@ -0,0 +1,151 @@
+'''Turn account status changes into field-level change events.
+
+    detector = ChangeDetector(account)
+    detector.subscribe(alert, fields=('temperature', 'away'))
+
+The detector listens for status changes on an account and remembers a
+fingerprint ($version and $timestamp) and the watched fields of every bucket.
+When the status changes, only buckets whose fingerprint changed, or that were
+written locally, are compared, and a Change is sent to subscribers for each
+watched field whose value changed.
+'''
+
+import logging
+import threading
+
+from nest import nest_fields
+
+
+LOG = logging.getLogger(__name__)
+
+# bucket type -> (bucket key, target kind, field name) for each watched field
+watched_fields = {
+    'structure': [('name', 'structure', 'name'),
+                  ('away', 'structure', 'away')],
+}
+for _field, (_bucket, _key) in nest_fields.items():
+    watched_fields.setdefault(_bucket, []).append((_key, 'nest', _field))
+
+
+def _fingerprint(value):
+    version = value.get('$version')
+    if version is None:
+        # nothing to go on, so the bucket always gets compared
+        return None
+    return version, value.get('$timestamp')
+
+
+class Change(object):
+    '''A change to one field of a Nest or Structure.
+
+    kind is "nest" or "structure", id is the Nest or Structure ID, and field
+    is a Nest field from nest.nest_fields (like "temperature" or "fan") or a
+    Structure field ("name" or "away"). Values are as Nest stores them, so
+    temperatures are in Celsius.
+    '''
+
+    __slots__ = ('kind', 'id', 'field', 'old', 'new')
+
+    def __init__(self, kind, id, field, old, new):
+        self.kind = kind
+        self.id = id
+        self.field = field
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return 'Change({}.{} {}: {!r} -> {!r})'.format(
+            self.kind, self.id, self.field, self.old, self.new)
+
+
+class ChangeDetector(object):
+    '''Emits Changes for the Nests and Structures of an account.
+
+    The first time a bucket is seen its fields are recorded without sending
+    any events.
+    '''
+
+    def __init__(self, account):
+        self._account = account
+        self._lock = threading.Lock()
+        # (bucket, id) -> [fingerprint, {key: value}]
+        self._buckets = {}
+        self._subscribers = []
+        if account._status is not None:
+            self._update(None)
+        account.add_status_listener(self._update)
+
+    def close(self):
+        '''Stop watching the account'''
+        self._account.remove_status_listener(self._update)
+
+    def subscribe(self, callback, fields=None, kind=None):
+        '''Call callback(change) for each Change.
+
+        If fields is given, only changes to those fields are sent; likewise
+        for kind ("nest" or "structure").
+        '''
+        fields = frozenset(fields) if fields is not None else None
+        self._subscribers.append((callback, fields, kind))
+
+    def unsubscribe(self, callback):
+        '''Remove a subscribed callback'''
+        self._subscribers = [s for s in self._subscribers
+                             if s[0] is not callback]
+
+    def _update(self, keys):
+        status = self._account._status
+        if status is None:
+            return
+
+        if keys is None:
+            entries = [(bucket, id, value) for bucket in watched_fields
+                       for id, value in status.get(bucket, {}).iteritems()]
+            written = False
+        else:
+            entries = [(bucket, id, status.get(bucket, {}).get(id))
+                       for bucket, id in keys if bucket in watched_fields]
+            # listed keys are always compared, since local writes change
+            # values without changing the fingerprint
+            written = True
+
+        changes = []
+        buckets = self._buckets
+        with self._lock:
+            for bucket, id, value in entries:
+                if not isinstance(value, dict):
+                    continue
+                fingerprint = _fingerprint(value)
+                known = buckets.get((bucket, id))
+                if (not written and known is not None and
+                        fingerprint is not None and
+                        known[0] == fingerprint):
+                    continue
+
+                fields = watched_fields[bucket]
+                current = dict((entry[0], value.get(entry[0]))
+                               for entry in fields)
+                if known is not None:
+                    previous = known[1]
+                    for key, kind, field in fields:
+                        if previous[key] != current[key]:
+                            changes.append(Change(kind, id, field,
+                                                  previous[key],
+                                                  current[key]))
+                # a written bucket is compared again when it's next seen
+                buckets[(bucket, id)] = [
+                    None if written else fingerprint, current]
+
+        for change in changes:
+            self._emit(change)
+
+    def _emit(self, change):
+        for callback, fields, kind in list(self._subscribers):
+            if fields is not None and change.field not in fields:
+                continue
+            if kind is not None and change.kind != kind:
+                continue
+            try:
+                callback(change)
+            except Exception:
+                LOG.exception('change subscriber failed')
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+'''Serve a warm Nest account over a Unix domain socket.
+
+The daemon owns one Account, with its connection pool and status cache, and
+keeps the status fresh in the background. Clients send one JSON object per
+line and get one JSON object back per line, so a command costs a single local
+round trip instead of a login, a TLS handshake and a status download.
+
+    python nest_daemon.py serve &
+    python nest_daemon.py get temperature
+    python nest_daemon.py set fan on
+
+When NEST_EMAIL and NEST_PASSWORD are set, the daemon logs in again with them
+before its session expires.
+'''
+
+import json
+import logging
+import socket
+import threading
+from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+from os import chmod, environ, remove
+from os.path import exists, join
+
+import nest as nestlib
+
+
+LOG = logging.getLogger(__name__)
+
+default_socket_name = 'daemon.sock'
+default_refresh_interval = 15 * 60
+
+
+class DaemonError(Exception):
+    '''An error reported by the daemon for a request'''
+
+
+def env_credentials():
+    '''Credentials from NEST_EMAIL and NEST_PASSWORD, if they're set'''
+    email = environ.get('NEST_EMAIL')
+    password = environ.get('NEST_PASSWORD')
+    if email and password:
+        return email, password
+    return None
+
+
+def socket_path(cache_dir=None):
+    '''The default socket path for a cache dir'''
+    if cache_dir is None:
+        cache_dir = nestlib.default_cache_dir
+    return join(cache_dir, default_socket_name)
+
+
+class DaemonHandler(StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = {'ok': True,
+                            'result': self.server.dispatch(request)}
+            except Exception as e:
+                LOG.exception('request failed: %s', line.strip())
+                response = {'ok': False, 'error': str(e) or repr(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class Daemon(ThreadingUnixStreamServer):
+    '''A server that answers requests from one warm Account.
+
+    Requests are JSON objects with an "op" key. The built-in ops are "ping",
+    "nests", "get", "set", "status" and "refresh"; others can be added with
+    register().
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, account, path=None, refresh_interval=None):
+        if path is None:
+            path = socket_path(account.cache_dir)
+        if refresh_interval is None:
+            refresh_interval = default_refresh_interval
+
+        if exists(path):
+            # a socket left behind by a daemon that's no longer running
+            if _is_listening(path):
+                raise DaemonError('A daemon is already listening on ' + path)
+            remove(path)
+
+        ThreadingUnixStreamServer.__init__(self, path, DaemonHandler)
+        chmod(path, 0600)
+        self.path = path
+        self.account = account
+        self._refresh_interval = refresh_interval
+        self._stop = threading.Event()
+        self._handlers = {
+            'ping': lambda request: 'pong',
+            'nests': self._nests,
+            'get': self._get,
+            'set': self._set,
+            'status': self._status,
+            'refresh': self._refresh,
+        }
+
+    def register(self, op, handler):
+        '''Handle requests for op with handler(request)'''
+        self._handlers[op] = handler
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op not in self._handlers:
+            raise DaemonError('Unknown op "{}"'.format(op))
+        return self._handlers[op](request)
+
+    def _nest(self, request):
+        nest_id = request.get('nest')
+        if nest_id is None:
+            return self.account.nests.values()[0]
+        return self.account.nest(nest_id, request.get('structure'))
+
+    def _nests(self, request):
+        return dict((id, nest.name) for id, nest in
+                    self.account.nests.items())
+
+    def _get(self, request):
+        name = request['name']
+        if name == 'away':
+            return self._nest(request).structure.away
+        if name not in nestlib.readable_properties:
+            raise DaemonError('Unknown property "{}"'.format(name))
+        return getattr(self._nest(request), name)
+
+    def _set(self, request):
+        name = request['name']
+        value = request['value']
+        nest = self._nest(request)
+        if name == 'away':
+            nest.structure.away = value
+        elif name in nestlib.settable_properties:
+            if isinstance(value, list):
+                value = tuple(value)
+            setattr(nest, name, value)
+        else:
+            raise DaemonError('Property "{}" can\'t be set'.format(name))
+        return True
+
+    def _status(self, request):
+        nest = self._nest(request)
+        status = dict((name, getattr(nest, name))
+                      for name in nestlib.readable_properties)
+        status['id'] = nest.id
+        status['away'] = nest.structure.away
+        return status
+
+    def _refresh(self, request):
+        self.account.refresh()
+        return self.account.status_version
+
+    def _keep_fresh(self):
+        '''Refresh the whole status now and then in case changes are missed'''
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.account.refresh()
+            except Exception:
+                LOG.exception('background refresh failed')
+
+    def serve_forever(self, poll_interval=0.5):
+        '''Load the status, start watching for changes, and serve requests'''
+        self.account.status
+        self.account.listen()
+        refresher = threading.Thread(target=self._keep_fresh)
+        refresher.daemon = True
+        refresher.start()
+        LOG.info('serving on %s', self.path)
+        try:
+            ThreadingUnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            self._stop.set()
+            self.account.stop_listening()
+
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        if exists(self.path):
+            remove(self.path)
+
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class Client(object):
+    '''A connection to a running daemon.
+
+    Connecting raises socket.error if no daemon is listening, so callers can
+    fall back to using an Account directly.
+    '''
+
+    def __init__(self, path=None, timeout=None):
+        if path is None:
+            path = socket_path()
+        if timeout is None:
+            timeout = nestlib.default_timeout
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+        except socket.error:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rb')
+
+    def call(self, op, **args):
+        '''Send a request and return its result'''
+        args['op'] = op
+        self._sock.sendall(json.dumps(args) + '\n')
+        line = self._file.readline()
+        if not line:
+            raise DaemonError('The daemon closed the connection')
+        response = json.loads(line)
+        if not response['ok']:
+            raise DaemonError(response['error'])
+        return response['result']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Serve a Nest account over a Unix '
+                            'socket, or send a command to the server')
+    parser.add_argument('--socket', help='Socket path')
+    parser.add_argument('--cache-dir', help='Account cache dir')
+    parser.add_argument('--nest', help='Nest ID (defaults to the first Nest)')
+    parser.add_argument('command', choices=('serve', 'ping', 'nests', 'get',
+                                            'set', 'status', 'refresh'))
+    parser.add_argument('args', nargs='*')
+    args = parser.parse_args()
+    path = args.socket or socket_path(args.cache_dir)
+
+    if args.command == 'serve':
+        logging.basicConfig(level=logging.INFO)
+        # with a status TTL, refreshes are saved to the status snapshot that
+        # other processes read
+        account = nestlib.Account(cache_dir=args.cache_dir,
+                                  status_ttl=default_refresh_interval,
+                                  credentials=env_credentials,
+                                  refresh_in_thread=True)
+        server = Daemon(account, path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        request = {'nest': args.nest}
+        if args.command in ('get', 'set'):
+            request['name'] = args.args[0]
+        if args.command == 'set':
+            # values are JSON where possible, so "21.5" and "[19, 24]" work
+            try:
+                request['value'] = json.loads(args.args[1])
+            except ValueError:
+                request['value'] = args.args[1]
+        try:
+            client = Client(path)
+        except socket.error:
+            raise SystemExit('No daemon is listening on ' + path)
+        with client:
+            print json.dumps(client.call(args.command, **request))
@@ -0,0 +1,190 @@
+'''Refresh the status of many Nest accounts at once.'''
+
+import logging
+import random
+import threading
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+
+from nest import FailedRequest, Instrument
+
+
+LOG = logging.getLogger(__name__)
+
+
+default_workers = 8
+default_backoff = 30.0
+default_max_backoff = 3600.0
+
+
+class RequestBudget(Instrument):
+    '''A token bucket that limits the request rate across a fleet.
+
+    As an account instrument it takes a token before every request the
+    account sends, so retries and hedged requests are counted too.
+    '''
+
+    def __init__(self, rate, burst=None):
+        '''Initialize a budget of `rate` requests per second.
+
+        burst defaults to rate, and is at least 1 so that a token can always
+        be taken.
+        '''
+        self._rate = float(rate)
+        self._burst = max(1.0, float(burst or rate))
+        self._tokens = self._burst
+        self._last = time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a request may be made'''
+        while True:
+            with self._lock:
+                now = time()
+                self._tokens = min(self._burst, self._tokens +
+                                   (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            sleep(wait)
+
+    def before_request(self, method, endpoint, url):
+        self.acquire()
+
+
+class CycleReport(object):
+    '''The result of one polling cycle.'''
+
+    def __init__(self, started):
+        self.started = started
+        self.elapsed = None
+        # account -> seconds taken to refresh it
+        self.times = {}
+        # account -> exception raised while refreshing it
+        self.failures = {}
+        # accounts that were skipped because they're backing off
+        self.skipped = []
+
+    @property
+    def refreshed(self):
+        return len(self.times) - len(self.failures)
+
+    def __repr__(self):
+        return ('<CycleReport refreshed={} failed={} skipped={} '
+                'elapsed={:.3f}>'.format(self.refreshed, len(self.failures),
+                                         len(self.skipped),
+                                         self.elapsed or 0))
+
+
+class Fleet(object):
+    def __init__(self, accounts, workers=None, budget=None, backoff=None,
+                 max_backoff=None):
+        '''Initialize a fleet of accounts.
+
+        Account statuses are refreshed in parallel by up to `workers` threads.
+        If `budget` is given, no more than that many requests per second are
+        made across the whole fleet; it's added to each account as an
+        instrument. An account whose refresh fails with
+        FailedRequest is skipped for a jittered, exponentially growing delay
+        starting at `backoff` seconds and capped at `max_backoff`.
+        '''
+        self._accounts = []
+        self._workers = workers or default_workers
+        self._budget = RequestBudget(budget) if budget else None
+        self._backoff = backoff or default_backoff
+        self._max_backoff = max_backoff or default_max_backoff
+        self._failures = {}
+        self._retry_at = {}
+        self._pool = None
+        for account in accounts:
+            self.add(account)
+
+    @property
+    def accounts(self):
+        return self._accounts
+
+    def add(self, account):
+        '''Add an account to the fleet'''
+        self._accounts.append(account)
+        if self._budget:
+            account.add_instrument(self._budget)
+
+    def remove(self, account):
+        '''Remove an account from the fleet'''
+        self._accounts.remove(account)
+        if self._budget:
+            account.remove_instrument(self._budget)
+        self._failures.pop(account, None)
+        self._retry_at.pop(account, None)
+
+    def backoff_remaining(self, account):
+        '''Seconds until a backing-off account will be polled again'''
+        return max(0, self._retry_at.get(account, 0) - time())
+
+    def poll(self):
+        '''Refresh every account that isn't backing off'''
+        report = CycleReport(time())
+        due = []
+        for account in self._accounts:
+            if self.backoff_remaining(account) > 0:
+                report.skipped.append(account)
+            else:
+                due.append(account)
+
+        if self._pool is None:
+            self._pool = ThreadPool(self._workers)
+
+        for account, elapsed, error in self._pool.imap_unordered(
+                self._refresh, due):
+            report.times[account] = elapsed
+            if error is None:
+                self._failures.pop(account, None)
+                self._retry_at.pop(account, None)
+            else:
+                report.failures[account] = error
+                self._back_off(account)
+
+        report.elapsed = time() - report.started
+        LOG.debug('poll finished: %s', report)
+        return report
+
+    def run(self, interval, callback=None, cycles=None):
+        '''Poll every `interval` seconds, passing each report to callback'''
+        count = 0
+        while cycles is None or count < cycles:
+            report = self.poll()
+            if callback:
+                callback(report)
+            count += 1
+            if cycles is None or count < cycles:
+                sleep(max(0, interval - report.elapsed))
+
+    def close(self):
+        '''Stop the worker threads'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _refresh(self, account):
+        start = time()
+        error = None
+        try:
+            account.refresh()
+        except FailedRequest as e:
+            LOG.warn('refresh of %s failed: %s', account.cache_dir, e)
+            error = e
+        except Exception as e:
+            LOG.exception('refresh of %s failed', account.cache_dir)
+            error = e
+        return account, time() - start, error
+
+    def _back_off(self, account):
+        failures = self._failures.get(account, 0) + 1
+        self._failures[account] = failures
+        delay = min(self._max_backoff, self._backoff * 2 ** (failures - 1))
+        delay = random.uniform(delay / 2, delay)
+        self._retry_at[account] = time() + delay
+        LOG.debug('backing off %s for %.1fs', account.cache_dir, delay)
@@ -0,0 +1,255 @@
+'''Record Nest readings over time in memory-mapped column files.
+
+Each device gets a directory under <cache_dir>/history containing one file per
+column. A column file is a flat array of fixed-width values, so rows can be
+appended cheaply and any range of rows can be read without loading the rest
+of the history.
+'''
+
+import logging
+import mmap
+import struct
+from array import array
+from os import makedirs
+from os.path import exists, getsize, join
+from time import time
+
+from nest import default_cache_dir, nest_fields
+
+
+LOG = logging.getLogger(__name__)
+
+nan = float('nan')
+
+# the column that rows are ordered by
+time_column = ('time', 'd')
+
+# (name, array typecode) for each recorded value; temperatures are in Celsius,
+# booleans are stored as 1 or 0, and missing values as NaN or -1
+columns = (
+    ('temperature', 'f'),
+    ('humidity', 'f'),
+    ('target_temperature', 'f'),
+    ('target_temperature_low', 'f'),
+    ('target_temperature_high', 'f'),
+    ('fan', 'b'),
+    ('leaf', 'b'),
+    ('away', 'b'),
+)
+
+# rows are read in chunks of this many when scanning a range
+chunk_rows = 4096
+
+
+def _encode(name, value):
+    if name == 'fan':
+        value = None if value is None else value == 'on'
+    if isinstance(value, bool) or name in ('leaf', 'away', 'fan'):
+        return -1 if value is None else int(bool(value))
+    return nan if value is None else float(value)
+
+
+def _read_row(status, device_id, structure_id):
+    row = []
+    for name, code in columns:
+        if name == 'away':
+            bucket, key, id = 'structure', 'away', structure_id
+        else:
+            (bucket, key), id = nest_fields[name], device_id
+        row.append(_encode(name, status.get(bucket, {}).get(id, {}).get(key)))
+    return row
+
+
+class Column(object):
+    '''A memory-mapped, append-only array of fixed-width values.'''
+
+    def __init__(self, path, typecode):
+        self._path = path
+        self._typecode = typecode
+        self._width = struct.calcsize(typecode)
+        self._file = None
+
+    @property
+    def typecode(self):
+        return self._typecode
+
+    def __len__(self):
+        if not exists(self._path):
+            return 0
+        return getsize(self._path) // self._width
+
+    def _append_file(self):
+        if self._file is None:
+            self._file = open(self._path, 'ab')
+        return self._file
+
+    def append(self, value):
+        '''Write a value; it isn't visible to readers until flush()'''
+        self._append_file().write(array(self._typecode, [value]).tostring())
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def truncate(self, count):
+        '''Drop any rows after the first `count`'''
+        if len(self) > count:
+            self._append_file().truncate(count * self._width)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self, start, stop):
+        '''Read rows [start, stop) into an array'''
+        values = array(self._typecode)
+        stop = min(stop, len(self))
+        if start >= stop:
+            return values
+        with open(self._path, 'rb') as cfile:
+            data = mmap.mmap(cfile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                values.fromstring(data[start * self._width:
+                                       stop * self._width])
+            finally:
+                data.close()
+        return values
+
+    def bisect(self, value, count):
+        '''Find the first of the first `count` rows that is >= value.
+
+        The column must be sorted. Only the rows that are probed are read.
+        '''
+        if count == 0:
+            return 0
+        width = self._width
+        with open(self._path, 'rb') as cfile:
+            data = mmap.mmap(cfile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if struct.unpack_from(self._typecode, data,
+                                          mid * width)[0] < value:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return lo
+            finally:
+                data.close()
+
+
+class Series(object):
+    '''The recorded history of one device.'''
+
+    def __init__(self, path):
+        self._path = path
+        self._time = Column(join(path, 'time.col'), time_column[1])
+        self._columns = dict((name, Column(join(path, name + '.col'), code))
+                             for name, code in columns)
+
+    def __len__(self):
+        # a row is complete once its time has been written
+        return len(self._time)
+
+    def append(self, when, row):
+        if not exists(self._path):
+            makedirs(self._path)
+        count = len(self)
+        for (name, code), value in zip(columns, row):
+            column = self._columns[name]
+            # drop the rest of a row whose time was never written
+            column.truncate(count)
+            column.append(value)
+        for column in self._columns.values():
+            column.flush()
+        self._time.append(when)
+        self._time.flush()
+
+    def close(self):
+        '''Close the column files'''
+        self._time.close()
+        for column in self._columns.values():
+            column.close()
+
+    def _span(self, start, end):
+        count = len(self)
+        first = 0 if start is None else self._time.bisect(start, count)
+        last = count if end is None else self._time.bisect(end, count)
+        return first, last
+
+    def range(self, start=None, end=None, names=None):
+        '''Return the rows recorded in [start, end) as a dict of arrays'''
+        first, last = self._span(start, end)
+        result = {'time': self._time.read(first, last)}
+        for name in names or self._columns:
+            result[name] = self._columns[name].read(first, last)
+        return result
+
+    def downsample(self, name, bucket, start=None, end=None):
+        '''Summarize a column over fixed-size time buckets.
+
+        Returns a list of (bucket start, min, mean, max, count) tuples for the
+        buckets in [start, end) that have at least one value. Rows are read
+        in chunks, so memory use doesn't grow with the size of the range.
+        '''
+        first, last = self._span(start, end)
+        column = self._columns[name]
+        missing = -1 if column.typecode == 'b' else None
+        summary = []
+        current = None
+
+        for offset in range(first, last, chunk_rows):
+            stop = min(offset + chunk_rows, last)
+            times = self._time.read(offset, stop)
+            values = column.read(offset, stop)
+            for when, value in zip(times, values):
+                if value != value or value == missing:
+                    continue
+                key = when - (when % bucket)
+                if current is None or current[0] != key:
+                    if current is not None:
+                        summary.append(current)
+                    current = [key, value, 0.0, value, 0]
+                current[1] = min(current[1], value)
+                current[2] += value
+                current[3] = max(current[3], value)
+                current[4] += 1
+
+        if current is not None:
+            summary.append(current)
+        return [(bucket_start, lo, total / count, hi, count)
+                for bucket_start, lo, total, hi, count in summary]
+
+
+class Recorder(object):
+    def __init__(self, cache_dir=None):
+        '''Initialize a recorder that stores history under cache_dir'''
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        self._history_dir = join(cache_dir, 'history')
+        self._series = {}
+
+    def series(self, device_id):
+        '''Get the recorded history of a device'''
+        if device_id not in self._series:
+            self._series[device_id] = Series(join(self._history_dir,
+                                                  device_id))
+        return self._series[device_id]
+
+    def close(self):
+        '''Close the files of every series that's been used'''
+        for series in self._series.values():
+            series.close()
+
+    def record(self, account, when=None):
+        '''Append the current readings of every Nest in an account'''
+        if when is None:
+            when = time()
+        status = account.status
+        for structure in account.structures.values():
+            for device_id in structure.nests:
+                row = _read_row(status, device_id, structure.id)
+                self.series(device_id).append(when, row)
+        LOG.debug('recorded history at %s', when)
@@ -0,0 +1,182 @@
+'''Collect request metrics from Nest accounts.
+
+    metrics = Metrics()
+    account = nest.Account(instruments=[metrics])
+    ...
+    print metrics.to_json()
+    metrics.write_prometheus('/var/lib/node_exporter/nest.prom')
+'''
+
+import json
+import threading
+
+from nest import Instrument, write_file_atomically
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram(object):
+    '''A cumulative latency histogram.'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(('{:g}'.format(b), c)
+                            for b, c in zip(self.buckets, self.counts)),
+        }
+
+
+class EndpointStats(object):
+    '''Everything recorded about requests to one endpoint.'''
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status_codes = {}
+        self.errors = 0
+
+    def snapshot(self):
+        return {
+            'latency': self.latency.snapshot(),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'status_codes': dict((str(k), v)
+                                 for k, v in self.status_codes.items()),
+            'errors': self.errors,
+        }
+
+
+class Metrics(Instrument):
+    '''An Instrument that keeps per-endpoint request metrics.
+
+    One Metrics object can be shared by many accounts.
+    '''
+
+    def __init__(self, buckets=None):
+        self._buckets = tuple(buckets or default_buckets)
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._timings = {}
+
+    def _stats(self, method, endpoint):
+        key = (method, endpoint)
+        if key not in self._requests:
+            self._requests[key] = EndpointStats(self._buckets)
+        return self._requests[key]
+
+    def after_request(self, method, endpoint, url, request_bytes, response,
+                      elapsed):
+        with self._lock:
+            stats = self._stats(method, endpoint)
+            stats.latency.observe(elapsed)
+            stats.request_bytes += request_bytes
+            length = response.headers.get('Content-Length')
+            if length is None:
+                # don't read the body of a streamed response
+                length = len(getattr(response, '_content', None) or '')
+            stats.response_bytes += int(length)
+            code = response.status_code
+            stats.status_codes[code] = stats.status_codes.get(code, 0) + 1
+
+    def request_failed(self, method, endpoint, url, error, elapsed):
+        with self._lock:
+            stats = self._stats(method, endpoint)
+            stats.latency.observe(elapsed)
+            stats.errors += 1
+
+    def timing(self, name, elapsed):
+        with self._lock:
+            if name not in self._timings:
+                self._timings[name] = Histogram(self._buckets)
+            self._timings[name].observe(elapsed)
+
+    def reset(self):
+        '''Forget everything that's been recorded'''
+        with self._lock:
+            self._requests = {}
+            self._timings = {}
+
+    def snapshot(self):
+        '''Return the current metrics as a dict'''
+        with self._lock:
+            return {
+                'requests': dict(('{} {}'.format(method, endpoint),
+                                  stats.snapshot())
+                                 for (method, endpoint), stats
+                                 in self._requests.items()),
+                'timings': dict((name, histogram.snapshot())
+                                for name, histogram in self._timings.items()),
+            }
+
+    def to_json(self):
+        '''Export the current metrics as JSON'''
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''Export the current metrics in the Prometheus text format'''
+        lines = []
+
+        def histogram(name, labels, hist):
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(
+                    name, labels, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                name, labels, hist.count))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, hist.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, hist.count))
+
+        with self._lock:
+            requests = sorted(self._requests.items())
+            timings = sorted(self._timings.items())
+
+            lines.append('# HELP nest_request_seconds Nest request latency')
+            lines.append('# TYPE nest_request_seconds histogram')
+            for (method, endpoint), stats in requests:
+                labels = 'method="{}",endpoint="{}"'.format(method, endpoint)
+                histogram('nest_request_seconds', labels, stats.latency)
+
+            for name, attr in (('nest_request_bytes', 'request_bytes'),
+                               ('nest_response_bytes', 'response_bytes'),
+                               ('nest_request_errors', 'errors')):
+                lines.append('# TYPE {} counter'.format(name))
+                for (method, endpoint), stats in requests:
+                    lines.append('{}{{method="{}",endpoint="{}"}} {}'.format(
+                        name, method, endpoint, getattr(stats, attr)))
+
+            lines.append('# TYPE nest_responses counter')
+            for (method, endpoint), stats in requests:
+                for code, count in sorted(stats.status_codes.items()):
+                    lines.append('nest_responses{{method="{}",endpoint="{}",'
+                                 'code="{}"}} {}'.format(method, endpoint,
+                                                         code, count))
+
+            lines.append('# HELP nest_operation_seconds Time spent in client '
+                         'operations like login and status parsing')
+            lines.append('# TYPE nest_operation_seconds histogram')
+            for name, hist in timings:
+                histogram('nest_operation_seconds',
+                          'operation="{}"'.format(name), hist)
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''Atomically write the metrics to a Prometheus textfile'''
+        write_file_atomically(path, self.to_prometheus())
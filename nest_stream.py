@@ -0,0 +1,203 @@
+'''Decode Nest status responses incrementally.
+
+A status response is a JSON object of buckets ({"device": {"<id>": {...}}}).
+StatusParser scans the response a chunk at a time and only decodes the bucket
+objects it's been asked to keep, dropping every other field as it goes. Peak
+memory use is bounded by the data that's kept plus the largest single bucket
+object, rather than by the size of the response.
+'''
+
+import json
+import re
+
+
+# fields that are always kept for a bucket, so subscriptions keep working
+meta_fields = ('$version', '$timestamp')
+
+_whitespace = ' \t\r\n'
+_structure = re.compile(r'[{}\[\]"]')
+_string_end = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+_literal_end = re.compile(r'[,}\]\s]')
+
+
+class StatusParser(object):
+    '''An incremental parser for status responses.
+
+    fields maps bucket types to the fields to keep from each of their
+    objects, or to None to keep every field. Buckets that aren't in fields are
+    skipped without being decoded.
+    '''
+
+    def __init__(self, fields):
+        self._fields = fields
+        self._status = {}
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._bucket = None
+        self._id = None
+        # progress through the value being scanned
+        self._value_start = None
+        self._kind = None
+        self._depth = 0
+
+    def feed(self, chunk):
+        '''Parse another chunk of the response'''
+        self._buf += chunk
+        while self._step():
+            pass
+        self._compact()
+
+    def close(self):
+        '''Finish parsing and return the decoded status'''
+        if self._state != 'done':
+            raise ValueError('Incomplete status response')
+        return self._status
+
+    def _compact(self):
+        # drop everything that's been consumed
+        start = self._pos
+        if self._value_start is not None:
+            if self._wanted() or self._kind not in '{[':
+                start = self._value_start
+            else:
+                # skipped objects don't need to be kept while scanning
+                self._value_start = self._pos
+        if start:
+            self._buf = self._buf[start:]
+            self._pos -= start
+            if self._value_start is not None:
+                self._value_start -= start
+
+    def _wanted(self):
+        return self._bucket in self._fields
+
+    def _skip(self, chars):
+        buf = self._buf
+        pos = self._pos
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _string(self):
+        '''Read a complete string at the current position'''
+        match = _string_end.match(self._buf, self._pos + 1)
+        if match is None:
+            return None
+        text = self._buf[self._pos:match.end()]
+        self._pos = match.end()
+        return json.loads(text)
+
+    def _step(self):
+        '''Advance one step; returns False when more data is needed'''
+        state = self._state
+
+        if state == 'done':
+            self._pos = len(self._buf)
+            return False
+
+        if state == 'value':
+            return self._scan_value()
+
+        if not self._skip(_whitespace + ',:'):
+            return False
+        char = self._buf[self._pos]
+
+        if state == 'start':
+            if char != '{':
+                raise ValueError('Status response is not an object')
+            self._pos += 1
+            self._state = 'buckets'
+        elif state in ('buckets', 'ids'):
+            if char == '}':
+                self._pos += 1
+                self._state = 'done' if state == 'buckets' else 'buckets'
+                return True
+            key = self._string()
+            if key is None:
+                return False
+            if state == 'buckets':
+                self._bucket = key
+                self._state = 'bucket_open'
+            else:
+                self._id = key
+                self._state = 'value'
+                self._value_start = None
+        elif state == 'bucket_open':
+            if char != '{':
+                # not a bucket of objects; skip it
+                self._id = None
+                self._state = 'value'
+                self._value_start = None
+                return True
+            self._pos += 1
+            self._state = 'ids'
+        return True
+
+    def _scan_value(self):
+        buf = self._buf
+        if self._value_start is None:
+            if not self._skip(_whitespace + ':'):
+                return False
+            self._value_start = self._pos
+            self._kind = buf[self._pos]
+            self._depth = 0
+
+        char = self._kind
+        if char == '"':
+            self._pos = self._value_start
+            if self._string() is None:
+                return False
+        elif char in '{[':
+            pos = self._pos
+            while True:
+                match = _structure.search(buf, pos)
+                if match is None:
+                    self._pos = len(buf)
+                    return False
+                pos = match.start()
+                token = match.group()
+                if token == '"':
+                    end = _string_end.match(buf, pos + 1)
+                    if end is None:
+                        self._pos = pos
+                        return False
+                    pos = end.end()
+                    continue
+                pos += 1
+                if token in '{[':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._pos = pos
+                        break
+        else:
+            match = _literal_end.search(buf, self._value_start)
+            if match is None:
+                return False
+            self._pos = match.start()
+
+        self._finish_value(buf[self._value_start:self._pos])
+        self._value_start = None
+        self._state = 'ids' if self._id is not None else 'buckets'
+        return True
+
+    def _finish_value(self, text):
+        if not self._wanted() or self._id is None:
+            return
+        value = json.loads(text)
+        fields = self._fields[self._bucket]
+        if fields is not None and isinstance(value, dict):
+            value = dict((k, v) for k, v in value.items()
+                         if k in fields or k in meta_fields)
+        self._status.setdefault(self._bucket, {})[self._id] = value
+
+
+def parse_status(chunks, fields):
+    '''Decode a status response from an iterable of chunks'''
+    parser = StatusParser(fields)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()